@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# Copyright (c) 2014, Stanford University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+Checkpoints for scrubbing append-only input files incrementally.
+'''
+
+import hashlib
+import io
+import json
+import os
+
+class Checkpoint(object):
+    '''
+    How far a scrubber got through an append-only input file: the
+    number of input bytes and rows scrubbed, the size of the output
+    written for them, and a hash of the last input bytes scrubbed.
+
+    A scrubber saves a checkpoint at regular intervals while it runs,
+    and once more when done. The next run checks the hash to make sure
+    that the input was only appended to, cuts off any output written
+    after the last checkpoint (left over from a crash), and scrubs the
+    input from the checkpoint on, appending to the output.
+
+    The output is flushed to disk before each checkpoint is saved, and
+    the checkpoint file is replaced atomically, so a checkpoint never
+    refers to output that was lost in a crash.
+    '''
+
+    # Number of input bytes before the checkpoint that are hashed:
+    TAIL_SIZE = 4096
+
+    # Version of the checkpoint file format:
+    FORMAT_VERSION = 1
+
+    def __init__(self, file_name):
+        '''
+        A checkpoint at the start of the input. Use load()
+        to read an existing checkpoint.
+
+        :param file_name: file where the checkpoint is kept
+        :type file_name: String
+        '''
+        self.file_name = file_name
+        self.input_offset = 0
+        self.output_offset = 0
+        self.rows = 0
+        self.tail_hash = tail_hash(None, 0)
+
+    @classmethod
+    def load(cls, file_name):
+        '''
+        Read the checkpoint in file_name. If the file does not
+        exist, the checkpoint is at the start of the input.
+
+        :param file_name: file where the checkpoint is kept
+        :type file_name: String
+        :rtype: Checkpoint
+        :raises ValueError: if the file is not a checkpoint
+        '''
+        checkpoint = cls(file_name)
+        if not os.path.exists(file_name):
+            return checkpoint
+        with open(file_name, 'r') as fd:
+            try:
+                state = json.load(fd)
+                if state['version'] != cls.FORMAT_VERSION:
+                    raise ValueError("Checkpoint %s was saved by a different version" % file_name)
+                checkpoint.input_offset = state['input_offset']
+                checkpoint.output_offset = state['output_offset']
+                checkpoint.rows = state['rows']
+                checkpoint.tail_hash = state['tail_hash']
+            except (KeyError, TypeError):
+                raise ValueError("Not a checkpoint file: %s" % file_name)
+        return checkpoint
+
+    def open_output(self, infile_name, outfile_name):
+        '''
+        Make sure infile_name was only appended to since the
+        checkpoint, and open outfile_name for appending the output
+        of the input that follows the checkpoint.
+
+        :param infile_name: input file
+        :type infile_name: String
+        :param outfile_name: output file
+        :type outfile_name: String
+        :returns: output file, positioned at the checkpoint
+        :rtype: file
+        :raises ValueError: if either file changed in other ways
+            since the checkpoint
+        '''
+        if self.input_offset == 0 and self.output_offset == 0:
+            return open(outfile_name, 'w')
+        if os.path.getsize(infile_name) < self.input_offset or tail_hash(infile_name, self.input_offset) != self.tail_hash:
+            raise ValueError("%s was changed other than by appending since checkpoint %s; delete the checkpoint to scrub from the start" %
+                             (infile_name, self.file_name))
+        if not os.path.exists(outfile_name) or os.path.getsize(outfile_name) < self.output_offset:
+            raise ValueError("%s is shorter than recorded in checkpoint %s; delete the checkpoint to scrub from the start" %
+                             (outfile_name, self.file_name))
+        outfile = open(outfile_name, 'a')
+        # Drop output written after the checkpoint by a run that crashed:
+        outfile.truncate(self.output_offset)
+        return outfile
+
+    def save(self, infile_name, input_offset, rows, outfile):
+        '''
+        Record that the input up to input_offset has been scrubbed,
+        and the output written to outfile.
+
+        :param infile_name: input file
+        :type infile_name: String
+        :param input_offset: number of input bytes scrubbed
+        :type input_offset: int
+        :param rows: number of rows scrubbed
+        :type rows: int
+        :param outfile: output file opened by open_output()
+        :type outfile: file
+        '''
+        outfile.flush()
+        os.fsync(outfile.fileno())
+        self.input_offset = input_offset
+        self.output_offset = os.fstat(outfile.fileno()).st_size
+        self.rows = rows
+        self.tail_hash = tail_hash(infile_name, input_offset)
+        state = {'version'       : Checkpoint.FORMAT_VERSION,
+                 'input_offset'  : self.input_offset,
+                 'output_offset' : self.output_offset,
+                 'rows'          : self.rows,
+                 'tail_hash'     : self.tail_hash
+                 }
+        tmp_name = self.file_name + '.tmp'
+        with open(tmp_name, 'w') as fd:
+            json.dump(state, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp_name, self.file_name)
+
+def tail_hash(file_name, offset):
+    '''
+    Hash of the Checkpoint.TAIL_SIZE bytes of a file
+    that precede offset.
+
+    :param file_name: file to hash; None hashes no bytes
+    :type file_name: String
+    :param offset: end of the bytes to hash
+    :type offset: int
+    :rtype: String
+    '''
+    start = max(0, offset - Checkpoint.TAIL_SIZE)
+    data = b''
+    if file_name is not None:
+        with open(file_name, 'rb') as fd:
+            fd.seek(start)
+            data = fd.read(offset - start)
+    return hashlib.sha256(data).hexdigest()
+
+def complete_size(file_name):
+    '''
+    Number of bytes in a file up to the end of its last complete
+    line. Anything after that is a line still being appended.
+
+    :param file_name: file to check
+    :type file_name: String
+    :rtype: int
+    '''
+    with open(file_name, 'rb') as fd:
+        end = fd.seek(0, io.SEEK_END)
+        while end > 0:
+            start = max(0, end - io.DEFAULT_BUFFER_SIZE)
+            fd.seek(start)
+            newline = fd.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+    return 0
+
+class CompleteLines(object):
+    '''
+    Iterates over the lines of a binary file from its current position,
+    decoded as by open(file_name, 'r', newline=''). Stops before a final
+    line without line ending, which may still be being appended. The
+    offset attribute is the position after the last line returned; the
+    exhausted attribute tells whether the end of the lines was reached.
+    '''
+
+    def __init__(self, fd, encoding):
+        '''
+        :param fd: file opened in binary mode
+        :type fd: file
+        :param encoding: text encoding of the file
+        :type encoding: String
+        '''
+        self.offset = fd.tell()
+        self.encoding = encoding
+        self.lines = io.TextIOWrapper(fd, encoding=encoding, newline='')
+        self.exhausted = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.lines.readline()
+        if not line.endswith(('\n', '\r')):
+            self.exhausted = True
+            raise StopIteration
+        self.offset += len(line.encode(self.encoding))
+        return line
+
+class CompleteRecords(object):
+    '''
+    Iterates over the records parsed from CompleteLines, such as the
+    rows of a csv.reader. Stops before a record that the end of the
+    lines cut off: a quoted cell that spans lines, and whose closing
+    quote is still being appended. The offset attribute is the position
+    after the last record returned.
+
+    A parser returns a record as soon as it has read the record's last
+    line, so a record is cut off if the lines were exhausted before it
+    was returned.
+    '''
+
+    def __init__(self, records, lines):
+        '''
+        :param records: records parsed from lines
+        :type records: iterator
+        :param lines: lines of the records
+        :type lines: CompleteLines
+        '''
+        self.records = records
+        self.lines = lines
+        self.offset = lines.offset
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        record = next(self.records)
+        if self.lines.exhausted:
+            raise StopIteration
+        self.offset = self.lines.offset
+        return record
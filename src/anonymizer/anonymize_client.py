@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# Copyright (c) 2014, Stanford University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+Thin client for the scrubbing server in anonymize_server.py, and the
+framed protocol they speak. Takes the same input and output as
+anonymize_txt.py and anonymize_csv.py, but leaves the scrubbing to a
+server that is already running, so each run only pays for starting
+this small script.
+
+Every message is a frame: a one-byte frame kind, the payload length
+as a 4-byte big-endian integer, and the payload. A request is a HEADER
+frame with the request options as JSON, then DATA frames with the raw
+input bytes, then an END frame. The response is DATA frames with the
+scrubbed output, encoded as the request's 'encoding' option says, then
+an END frame; or an ERROR frame with a message, in place of the rest.
+
+The socket is in a directory that only its user can access. The client
+only sends data to a server run by the same user.
+
+Kept free of the scrubber modules, so that it starts quickly.
+'''
+
+import argparse
+import json
+import locale
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+
+# Frame kinds:
+HEADER = b'H'
+DATA   = b'D'
+END    = b'Z'
+ERROR  = b'E'
+
+# Frame kind and payload length:
+FRAME_HEADER = struct.Struct('>cI')
+
+# Largest payload accepted:
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Bytes of input sent per frame:
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+def default_socket():
+    '''
+    Socket path used when none is given: in $XDG_RUNTIME_DIR, which
+    belongs to the user, or else in a per-user directory in the temp
+    directory, which the server creates with mode 0700.
+
+    :rtype: String
+    '''
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'anonymizer.sock')
+    return os.path.join(tempfile.gettempdir(), 'anonymizer-%s' % os.getuid(), 'anonymizer.sock')
+
+DEFAULT_SOCKET = default_socket()
+
+def write_frame(sock, kind, payload=b''):
+    '''
+    Send one frame over a blocking socket.
+    '''
+    sock.sendall(FRAME_HEADER.pack(kind, len(payload)))
+    if payload:
+        sock.sendall(payload)
+
+def read_frame(fd):
+    '''
+    Read one frame from a binary file, such as socket.makefile('rb').
+
+    :returns: frame kind and payload
+    :rtype: (bytes, bytes)
+    :raises ValueError: if the connection ends in the middle of
+        a frame, or the frame is too large
+    '''
+    header = fd.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        raise ValueError("Scrubbing server closed the connection")
+    kind, size = FRAME_HEADER.unpack(header)
+    if size > MAX_FRAME_SIZE:
+        raise ValueError("Frame of %s bytes exceeds the maximum of %s" % (size, MAX_FRAME_SIZE))
+    payload = fd.read(size)
+    if len(payload) < size:
+        raise ValueError("Scrubbing server closed the connection")
+    return kind, payload
+
+def scrub(socket_path, request, infile, outfile, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Have the server scrub infile, and write the result to outfile.
+    Input is sent from a separate thread while output comes back,
+    so that neither side waits for the other.
+
+    :param socket_path: Unix domain socket the server listens on
+    :type socket_path: String
+    :param request: request options: 'kind' is 'txt' or 'csv';
+        CSV requests may have 'ignore_cols', a list of column indexes,
+        'streaming', a bool, and 'profile', a list of profile specs
+        with column indexes, as for anonymize_csv.py
+    :type request: {String : object}
+    :param infile: binary file to scrub
+    :type infile: file
+    :param outfile: binary file to write
+    :type outfile: file
+    :param chunk_size: bytes of input per frame
+    :type chunk_size: int
+    :raises ValueError: if the server reports an error, or is
+        run by another user
+    '''
+    request = dict(request)
+    request.setdefault('encoding', locale.getpreferredencoding(False))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        check_server_owner(sock, socket_path)
+        sender = threading.Thread(target=_send_input, args=(sock, request, infile, chunk_size), daemon=True)
+        sender.start()
+        with sock.makefile('rb') as responses:
+            while True:
+                kind, payload = read_frame(responses)
+                if kind == DATA:
+                    outfile.write(payload)
+                elif kind == END:
+                    break
+                elif kind == ERROR:
+                    raise ValueError(payload.decode('utf-8'))
+                else:
+                    raise ValueError("Unknown frame kind %r from scrubbing server" % kind)
+        sender.join()
+    finally:
+        sock.close()
+
+def check_server_owner(sock, socket_path):
+    '''
+    Make sure that the server at the other end of a connected socket
+    is run by the same user, before any data is sent to it. Uses the
+    peer credentials where the platform has them (Linux), and the
+    owner of the socket file otherwise.
+
+    :param sock: socket connected to socket_path
+    :type sock: socket.socket
+    :param socket_path: Unix domain socket the server listens on
+    :type socket_path: String
+    :raises ValueError: if another user runs the server
+    '''
+    if hasattr(socket, 'SO_PEERCRED'):
+        credentials = struct.Struct('3i')
+        _pid, uid, _gid = credentials.unpack(sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, credentials.size))
+    else:
+        uid = os.stat(socket_path).st_uid
+    if uid != os.getuid():
+        raise ValueError("Scrubbing server on %s is run by user %s, not by you; not sending it any data" % (socket_path, uid))
+
+def _send_input(sock, request, infile, chunk_size):
+    try:
+        write_frame(sock, HEADER, json.dumps(request).encode('utf-8'))
+        for chunk in iter(lambda: infile.read(chunk_size), b''):
+            write_frame(sock, DATA, chunk)
+        write_frame(sock, END)
+    except OSError:
+        # The server hung up, and says why in its response:
+        pass
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]), formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('-s', '--socket',
+                        action='store',
+                        help="Unix domain socket of the scrubbing server; default: %s" % DEFAULT_SOCKET,
+                        default=DEFAULT_SOCKET
+                        )
+    parser.add_argument('-i', '--infile',
+                        action='store',
+                        help="File containing text to scrub; default is STDIN",
+                        default=None
+                        )
+    parser.add_argument('-o', '--outfile',
+                        action='store',
+                        help="File to which scrubbed content is to be written; default is STDOUT",
+                        default=None
+                        )
+    parser.add_argument('--csv',
+                        action='store_true',
+                        help="Scrub CSV, as anonymize_csv.py does; default: scrub text, as anonymize_txt.py does",
+                        default=False
+                        )
+    parser.add_argument('-c', '--ignorecol',
+                        action='store',
+                        nargs='*',
+                        type=int,
+                        help="Indexes of CSV columns to ignore; default: scrub all columns.",
+                        default=[]
+                        )
+    parser.add_argument('-p', '--profile',
+                        action='store',
+                        nargs='*',
+                        help="Detectors to run on a CSV column, as <column index>=<detector>,<detector>...",
+                        default=[]
+                        )
+    parser.add_argument('--streaming',
+                        action='store_true',
+                        help="Let the CSV parser handle line breaks, as anonymize_csv.py --streaming does",
+                        default=False
+                        )
+
+    args = parser.parse_args();
+
+    if args.csv:
+        request = {'kind' : 'csv', 'ignore_cols' : args.ignorecol, 'profile' : args.profile, 'streaming' : args.streaming}
+    else:
+        request = {'kind' : 'txt'}
+    infile = open(args.infile, 'rb') if args.infile is not None else sys.stdin.buffer
+    outfile = open(args.outfile, 'wb') if args.outfile is not None else sys.stdout.buffer
+    try:
+        scrub(args.socket, request, infile, outfile)
+    except (OSError, ValueError) as e:
+        sys.stderr.write("Scrubbing failed: %s\n" % e)
+        sys.exit(1)
+    finally:
+        if args.infile is not None:
+            infile.close()
+        if args.outfile is not None:
+            outfile.close()
+        else:
+            outfile.flush()
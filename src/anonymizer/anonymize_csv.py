@@ -11,12 +11,20 @@
 # THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import argparse
+import collections
 import csv
+import io
+import itertools
+import json
+import locale
 import os
 import sys
 import re
 
-from anonymize_txt import TextScrubber
+from anonymize_checkpoint import Checkpoint, CompleteLines, CompleteRecords
+from anonymize_io import COMPRESSIONS, DEFAULT_BUFFER_SIZE, close_text
+from anonymize_names import NameDictionary
+from anonymize_txt import TextScrubber, LRUCache, Pseudonymizer, DETECTOR_NAMES, canonical_detectors, get_engine, imap_ordered
 
 
 class CSVScrubber(TextScrubber):
@@ -27,13 +35,81 @@ class CSVScrubber(TextScrubber):
     '''
 
 
-    def __init__(self, input_file=None, output_file=None, ignore_cols=[]):
+    # Number of rows sent to a worker process at a time:
+    DEFAULT_BATCH_SIZE = 1000
+
+    # Longer cells are not cached:
+    DEFAULT_CACHE_MAX_LEN = 256
+
+    # Rows are counted in scrub_row(), not per anonymize_text() call:
+    ROW_PER_FIELD = False
+
+    # Approximate number of rows between checkpoints when
+    # scrubbing incrementally:
+    DEFAULT_CHECKPOINT_ROWS = 100000
+
+    def __init__(self, input_file=None, output_file=None, ignore_cols=[],
+                 workers=1, batch_size=DEFAULT_BATCH_SIZE, streaming=False,
+                 profile=None, auto_profile_rows=0,
+                 cache_size=0, cache_max_len=DEFAULT_CACHE_MAX_LEN,
+                 collect_stats=False, num_slowest=10, names=None,
+                 checkpoint=None, checkpoint_rows=DEFAULT_CHECKPOINT_ROWS,
+                 in_compression=None, out_compression=None, io_threads=False, io_buffer_size=DEFAULT_BUFFER_SIZE,
+                 pseudonymizer=None, line_buffered=False):
         
-        TextScrubber.__init__(self, input_file, output_file)
+        TextScrubber.__init__(self, input_file, output_file, 
+                              workers=workers, 
+                              collect_stats=collect_stats, 
+                              num_slowest=num_slowest,
+                              names=names,
+                              checkpoint=checkpoint,
+                              in_compression=in_compression,
+                              out_compression=out_compression,
+                              io_threads=io_threads,
+                              io_buffer_size=io_buffer_size,
+                              pseudonymizer=pseudonymizer,
+                              line_buffered=line_buffered)
 
         # Columns to ignore when scrubbing
         self.ignore_cols = set(ignore_cols)
 
+        # Column index or header name --> detectors to run on
+        # that column. Columns not in the profile get all detectors:
+        self.profile = {}
+        for col, detectors in (profile or {}).items():
+            self.profile[col] = canonical_detectors(detectors)
+
+        # If > 0: number of initial rows to sample for turning off
+        # detectors that never fire in a column:
+        self.auto_profile_rows = auto_profile_rows
+
+        # Column index --> RedactionEngine. Profiles by header name,
+        # and auto-profiling, are added by profile_columns():
+        self.column_engines = {col : get_engine(detectors) 
+                               for col, detectors in self.profile.items() 
+                               if isinstance(col, int)}
+
+        # Cache of scrubbed cells, keyed by the detectors that ran and
+        # the cell text. Exports repeat cell values a lot, such as course
+        # names or canned replies. Each worker process has its own copy:
+        self.cache = LRUCache(cache_size) if cache_size > 0 else None
+        self.cache_max_len = cache_max_len
+
+        # In streaming mode csv.reader sees the raw input, and
+        # handles quoted cells that span lines. CR/LF are replaced
+        # by spaces only in cells that are scrubbed. Otherwise every
+        # CR/LF in the input is replaced before parsing, which
+        # breaks multi-line cells into separate rows:
+        self.streaming = streaming
+
+        if batch_size < 1:
+            raise ValueError("Batch size must be at least 1, but was %s" % batch_size)
+        self.batch_size = batch_size
+
+        if checkpoint_rows < 1:
+            raise ValueError("Rows between checkpoints must be at least 1, but was %s" % checkpoint_rows)
+        self.checkpoint_rows = checkpoint_rows
+
 
     def anonymize(self):
         '''
@@ -41,31 +117,281 @@ class CSVScrubber(TextScrubber):
         so that unittests can create a CSVScrubber instance without
         doing the actual work. Instead, unittests call individual methods.
         '''
+        if self.checkpoint_file is not None:
+            self.anonymize_incrementally()
+            return
+        infile_fd = outfile = None
         try:
-            if self.infile_name is None:
-                infile = sys.stdin
-                filtered    = (re.sub(TextScrubber.CR_LF_PATTERN,' ',row) for row in sys.stdin)
+            if self.streaming:
+                infile_fd   = self.open_input(newline='')
+                filtered    = infile_fd
             else:
-                infile_fd   = open(self.infile_name, 'r')
+                infile_fd   = self.open_input()
                 filtered    = (re.sub(TextScrubber.CR_LF_PATTERN,' ',row) for row in infile_fd)
                 
-            if self.outfile_name is None:
-                outfile = sys.stdout
-            else:
-                outfile = open(self.outfile_name, 'w')
+            outfile = self.open_output()
     
-            reader = csv.reader(filtered)
-            writer = csv.writer(outfile)
-            for row in reader:
-                row = [self.anonymize_text(t) if i not in self.ignore_cols else t for i, t in enumerate(row)]
-                writer.writerow(row)
-        finally:
-            if self.infile_name is not None:
-                infile_fd.close()
-            if self.outfile_name is not None:
-                outfile.close()
+            reader = self.profile_columns(csv.reader(filtered))
+            if self.workers > 1:
+                for rows in self.scrub_in_parallel(reader):
+                    outfile.write(format_csv(rows))
+                    if self.line_buffered:
+                        outfile.flush()
+            elif self.line_buffered:
+                # Interactive use: every row goes out as soon as it is scrubbed:
+                writer = csv.writer(outfile)
+                for row in reader:
+                    writer.writerow(self.scrub_row(row))
+                    outfile.flush()
             else:
-                outfile.flush()
+                # One write() call per batch of rows:
+                for rows in iter(lambda: list(itertools.islice(reader, self.batch_size)), []):
+                    outfile.write(format_csv(self.scrub_batch(rows)))
+        finally:
+            close_text(infile_fd)
+            close_text(outfile)
+
+    def anonymize_incrementally(self):
+        '''
+        Like TextScrubber.anonymize_incrementally(), but the checkpoint
+        moves forward at the end of the first batch after every
+        self.checkpoint_rows rows. Column profiles are always resolved
+        from the start of the input, so that appended rows are scrubbed
+        the same way as the rows before them.
+        '''
+        checkpoint = Checkpoint.load(self.checkpoint_file)
+        outfile = checkpoint.open_output(self.infile_name, self.outfile_name)
+        encoding = locale.getpreferredencoding(False)
+        try:
+            with open(self.infile_name, 'rb') as infile_fd:
+                lines = CompleteLines(infile_fd, encoding)
+                self.profile_columns(CompleteRecords(csv.reader(self.filter_lines(lines)), lines))
+            with open(self.infile_name, 'rb') as infile_fd:
+                infile_fd.seek(checkpoint.input_offset)
+                lines = CompleteLines(infile_fd, encoding)
+                # Rows whose last line is not appended yet are left for the next run:
+                rows = CompleteRecords(csv.reader(self.filter_lines(lines)), lines)
+                # Input offset at the end of each batch handed out:
+                batch_ends = collections.deque()
+                def batches():
+                    for batch in iter(lambda: list(itertools.islice(rows, self.batch_size)), []):
+                        batch_ends.append(rows.offset)
+                        yield batch
+                if self.workers > 1:
+                    results = imap_ordered(self, _scrub_rows, batches(), self.workers)
+                else:
+                    results = (self.scrub_batch(batch) for batch in batches())
+
+                num_rows = checkpoint.rows
+                input_offset = checkpoint.input_offset
+                for scrubbed in results:
+                    outfile.write(format_csv(scrubbed))
+                    num_rows += len(scrubbed)
+                    input_offset = batch_ends.popleft()
+                    if num_rows - checkpoint.rows >= self.checkpoint_rows:
+                        checkpoint.save(self.infile_name, input_offset, num_rows, outfile)
+                if input_offset != checkpoint.input_offset:
+                    checkpoint.save(self.infile_name, input_offset, num_rows, outfile)
+        finally:
+            outfile.close()
+
+    def filter_lines(self, lines):
+        '''
+        Prepare lines read with newline='' for csv.reader. In streaming
+        mode they are passed through. Otherwise line endings are turned
+        into spaces, as anonymize() does.
+
+        :param lines: lines, including their line endings
+        :type lines: iterable of String
+        :rtype: iterable of String
+        '''
+        if self.streaming:
+            return lines
+        return (line.rstrip('\r\n') + ' ' for line in lines)
+
+    def scrub_row(self, row):
+        '''
+        Anonymize all cells of one CSV row, except for the
+        ones in ignored columns.
+
+        :param row: cell values
+        :type row: [String]
+        :returns: scrubbed cell values
+        :rtype: [String]
+        '''
+        engines = self.column_engines
+        if self.stats is not None:
+            self.stats.row_num += 1
+        if self.cache is not None:
+            return [self.anonymize_cell(self.trimCrLf(t) if self.streaming else t, engines.get(i, self.engine)) 
+                    if i not in self.ignore_cols else t for i, t in enumerate(row)]
+        if self.streaming:
+            return [self.anonymize_text(self.trimCrLf(t), engines.get(i)) if i not in self.ignore_cols else t for i, t in enumerate(row)]
+        return [self.anonymize_text(t, engines.get(i)) if i not in self.ignore_cols else t for i, t in enumerate(row)]
+
+    def scrub_batch(self, rows):
+        '''
+        Scrub a batch of CSV rows, as handed out by stream().
+
+        :param rows: CSV rows
+        :type rows: [[String]]
+        :returns: scrubbed rows
+        :rtype: [[String]]
+        '''
+        return [self.scrub_row(row) for row in rows]
+
+    def anonymize_cell(self, text, engine):
+        '''
+        Like anonymize_text(), but consult self.cache first, and
+        cache the result.
+
+        :param text: cell value
+        :type text: String
+        :param engine: engine with the detectors to run on the cell
+        :type engine: RedactionEngine
+        :returns: scrubbed cell value
+        :rtype: String
+        '''
+        if len(text) > self.cache_max_len:
+            return self.anonymize_text(text, engine)
+        key = (engine.detectors, text)
+        scrubbed = self.cache.get(key)
+        if scrubbed is None:
+            scrubbed = self.anonymize_text(text, engine)
+            self.cache.put(key, scrubbed)
+        return scrubbed
+
+    def profile_columns(self, rows):
+        '''
+        Decide which detectors run on which column, and set
+        self.column_engines accordingly. Header names in self.profile
+        are looked up in the first row. If self.auto_profile_rows is
+        set, that many rows are sampled, and detectors that match
+        nothing in a column's sample are turned off for the column.
+
+        Rows read for these purposes are not lost: the returned
+        iterator yields all of the rows, starting with the first.
+
+        :param rows: iterable of CSV rows, such as a csv.reader
+        :type rows: iterable of [String]
+        :returns: all rows
+        :rtype: iterator of [String]
+        :raises ValueError: if a header name is not in the first row
+        '''
+        rows = iter(rows)
+        needs_header = any(not isinstance(col, int) for col in self.profile)
+        sample = list(itertools.islice(rows, max(self.auto_profile_rows, int(needs_header))))
+
+        # Column index --> detector names:
+        col_detectors = {}
+        header = sample[0] if sample else []
+        for col, detectors in self.profile.items():
+            if not isinstance(col, int):
+                try:
+                    col = header.index(col)
+                except ValueError:
+                    raise ValueError("Profiled column '%s' is not in the CSV header" % col)
+            col_detectors[col] = detectors
+
+        if self.auto_profile_rows > 0:
+            num_cols = max(len(row) for row in sample) if sample else 0
+            for col in range(num_cols):
+                cells = [row[col] for row in sample if col < len(row)]
+                col_detectors[col] = tuple(detector 
+                                           for detector in col_detectors.get(col, DETECTOR_NAMES)
+                                           if any(get_engine((detector,)).pattern.search(cell) for cell in cells))
+
+        self.column_engines = {col : get_engine(detectors) for col, detectors in col_detectors.items()}
+        return itertools.chain(sample, rows)
+
+    def scrub_in_parallel(self, rows):
+        '''
+        Scrubs rows in a pool of self.workers processes. Rows are sent
+        to the workers in batches of self.batch_size, and the scrubbed
+        batches come back in input order. Input is only read as results
+        are consumed, so memory stays bounded; see imap_ordered().
+
+        :param rows: iterable of CSV rows, such as a csv.reader
+        :type rows: iterable of [String]
+        :returns: lists of scrubbed rows
+        :rtype: generator of [[String]]
+        '''
+        rows = iter(rows)
+        batches = iter(lambda: list(itertools.islice(rows, self.batch_size)), [])
+        return imap_ordered(self, _scrub_rows, batches, self.workers)
+
+    def take_counts(self):
+        counts = TextScrubber.take_counts(self)
+        if self.cache is not None:
+            counts['cache'] = self.cache.take_counts()
+        return counts
+
+    def add_counts(self, counts):
+        TextScrubber.add_counts(self, counts)
+        if self.cache is not None:
+            self.cache.add_counts(counts['cache'])
+
+    def report(self):
+        report = TextScrubber.report(self)
+        if self.cache is not None:
+            report += '\n' + self.cache.report()
+        return report
+
+def _scrub_rows(scrubber, rows):
+    return scrubber.scrub_batch(rows)
+
+def format_csv(rows):
+    '''
+    Format rows the way csv.writer() writes them, as one string,
+    so that they can be written with a single write() call.
+
+    :param rows: CSV rows
+    :type rows: [[String]]
+    :rtype: String
+    '''
+    chunk = io.StringIO()
+    csv.writer(chunk).writerows(rows)
+    return chunk.getvalue()
+
+def parse_profile(specs):
+    '''
+    Turn column profile specs of the form <column>=<detector>,<detector>...
+    into a profile dict, as accepted by CSVScrubber. Columns are
+    column indexes or header names. An empty detector list, as in
+    'id=', means that no detector runs on the column.
+
+    :param specs: column profile specs
+    :type specs: [String]
+    :returns: column index or header name --> detector names
+    :rtype: {int|String : (String)}
+    :raises ValueError: if a spec is malformed, or names an unknown detector
+    '''
+    profile = {}
+    for spec in specs:
+        col, sep, detectors = spec.partition('=')
+        if not sep or not col:
+            raise ValueError("Column profile must look like <column>=<detector>,<detector>..., but was '%s'" % spec)
+        profile[_column_key(col)] = canonical_detectors([detector for detector in detectors.split(',') if detector])
+    return profile
+
+def load_profile(file_name):
+    '''
+    Read a column profile from a JSON file that maps column indexes
+    or header names to lists of detectors, such as:
+
+        {"0": [], "comment": ["phone", "email"], "zip_code": ["zip"]}
+
+    :param file_name: JSON file
+    :type file_name: String
+    :returns: column index or header name --> detector names
+    :rtype: {int|String : (String)}
+    '''
+    with open(file_name, 'r') as fd:
+        return {_column_key(col) : canonical_detectors(detectors) for col, detectors in json.load(fd).items()}
+
+def _column_key(col):
+    # Column indexes come in as strings:
+    return int(col) if col.isdigit() else col
 
 if __name__ == '__main__':
 
@@ -84,9 +410,131 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--ignorecol',
                         action='store',
                         nargs='*',
-                        help="Use this option for each CSV column to ignore (origin 1); default: scrub all columns.",
+                        help="Indexes of CSV columns to ignore, origin 0: 0 is the first column; default: scrub all columns.",
                         default=[]
                         )
+    parser.add_argument('-w', '--workers',
+                        action='store',
+                        type=int,
+                        help="Number of processes that scrub in parallel; default: 1",
+                        default=1
+                        )
+    parser.add_argument('-b', '--batchsize',
+                        action='store',
+                        type=int,
+                        help="Number of rows handed to a worker process at a time; default: %s" % CSVScrubber.DEFAULT_BATCH_SIZE,
+                        default=CSVScrubber.DEFAULT_BATCH_SIZE
+                        )
+    parser.add_argument('-k', '--checkpoint',
+                        action='store',
+                        help="Checkpoint file for scrubbing an append-only infile incrementally:\n"
+                             "only rows appended since the last run are scrubbed, and appended\n"
+                             "to outfile. A crashed run resumes from its last checkpoint.",
+                        default=None
+                        )
+    parser.add_argument('--checkpointrows',
+                        action='store',
+                        type=int,
+                        help="Approximate number of rows between checkpoints; default: %s" % CSVScrubber.DEFAULT_CHECKPOINT_ROWS,
+                        default=CSVScrubber.DEFAULT_CHECKPOINT_ROWS
+                        )
+    parser.add_argument('-p', '--profile',
+                        action='store',
+                        nargs='*',
+                        help="Detectors to run on a column, as <column>=<detector>,<detector>...\n"
+                             "Columns are indexes, origin 0 as for --ignorecol, or header names.\n"
+                             "Detectors: %s. Unprofiled columns get all detectors." % ', '.join(DETECTOR_NAMES),
+                        default=[]
+                        )
+    parser.add_argument('-f', '--profilefile',
+                        action='store',
+                        help="JSON file mapping columns to lists of detectors",
+                        default=None
+                        )
+    parser.add_argument('-a', '--autoprofile',
+                        action='store',
+                        type=int,
+                        help="Sample this many initial rows, and turn off detectors that never\n"
+                             "fire in a column. PII that first shows up later in such a column\n"
+                             "is not redacted; default: 0 (no sampling)",
+                        default=0
+                        )
+    parser.add_argument('--cachesize',
+                        action='store',
+                        type=int,
+                        help="Number of scrubbed cell values to remember for reuse; default: 0 (no cache)",
+                        default=0
+                        )
+    parser.add_argument('--cachemaxlen',
+                        action='store',
+                        type=int,
+                        help="Cells longer than this are not cached; default: %s" % CSVScrubber.DEFAULT_CACHE_MAX_LEN,
+                        default=CSVScrubber.DEFAULT_CACHE_MAX_LEN
+                        )
+    parser.add_argument('-n', '--names',
+                        action='store',
+                        help="File with names to redact, one per line. The lookup tables built from\n"
+                             "it are kept in <file>.trie, and rebuilt when the file changes.",
+                        default=None
+                        )
+    parser.add_argument('--stats',
+                        action='store_true',
+                        help="Profile the detectors, and print run statistics to STDERR when done",
+                        default=False
+                        )
+    parser.add_argument('--slowest',
+                        action='store',
+                        type=int,
+                        help="Number of slowest fields to list with --stats; default: 10",
+                        default=10
+                        )
+    parser.add_argument('-s', '--streaming',
+                        action='store_true',
+                        help="Let the CSV parser handle line breaks, so quoted cells may span lines;\n"
+                             "line breaks are replaced by spaces only in scrubbed cells.",
+                        default=False
+                        )
+    parser.add_argument('--incompression',
+                        action='store',
+                        choices=COMPRESSIONS + ('none',),
+                        help="Compression of infile; default: by extension (.gz, .bz2, .xz, .zst)",
+                        default=None
+                        )
+    parser.add_argument('--outcompression',
+                        action='store',
+                        choices=COMPRESSIONS + ('none',),
+                        help="Compression of outfile; default: by extension (.gz, .bz2, .xz, .zst)",
+                        default=None
+                        )
+    parser.add_argument('--iothreads',
+                        action='store_true',
+                        help="Decompress input and compress output in separate threads",
+                        default=False
+                        )
+    parser.add_argument('--iobuffersize',
+                        action='store',
+                        type=int,
+                        help="Bytes read or written at a time; default: %s" % DEFAULT_BUFFER_SIZE,
+                        default=DEFAULT_BUFFER_SIZE
+                        )
+    parser.add_argument('--linebuffered',
+                        action='store_true',
+                        help="Write out each row as soon as it is scrubbed, for interactive use",
+                        default=False
+                        )
+    parser.add_argument('--pseudokey',
+                        action='store',
+                        help="File holding a secret key. With it, phone numbers, zipcodes and emails\n"
+                             "are replaced by stable tokens such as <email:3fa9c1d2e4b5>, computed\n"
+                             "with a keyed hash, rather than by <xxxRedac>",
+                        default=None
+                        )
+    parser.add_argument('--tokenlength',
+                        action='store',
+                        type=int,
+                        help="Number of hex digits in tokens; default: %s" % Pseudonymizer.DEFAULT_TOKEN_LENGTH,
+                        default=Pseudonymizer.DEFAULT_TOKEN_LENGTH
+                        )
     
     args = parser.parse_args();
 
@@ -98,5 +546,41 @@ if __name__ == '__main__':
         print("Colums to ignore must integer(s), but were: %s" % str(args.ignorecol))
         sys.exit()
 
-    scrubber = CSVScrubber(input_file=args.infile, output_file=args.outfile, ignore_cols=ignorecol)
+    try:
+        profile = load_profile(args.profilefile) if args.profilefile is not None else {}
+        profile.update(parse_profile(args.profile))
+    except (IOError, ValueError) as e:
+        print("Bad column profile: %s" % str(e))
+        sys.exit()
+
+    pseudonymizer = None
+    if args.pseudokey is not None:
+        with open(args.pseudokey, 'rb') as fd:
+            pseudonymizer = Pseudonymizer(fd.read().strip(), token_length=args.tokenlength)
+
+    scrubber = CSVScrubber(input_file=args.infile, 
+                           output_file=args.outfile, 
+                           ignore_cols=ignorecol,
+                           workers=args.workers,
+                           batch_size=args.batchsize,
+                           streaming=args.streaming,
+                           profile=profile,
+                           auto_profile_rows=args.autoprofile,
+                           cache_size=args.cachesize,
+                           cache_max_len=args.cachemaxlen,
+                           collect_stats=args.stats,
+                           num_slowest=args.slowest,
+                           names=NameDictionary.load_or_build(args.names) if args.names is not None else None,
+                           checkpoint=args.checkpoint,
+                           checkpoint_rows=args.checkpointrows,
+                           in_compression=args.incompression,
+                           out_compression=args.outcompression,
+                           io_threads=args.iothreads,
+                           io_buffer_size=args.iobuffersize,
+                           pseudonymizer=pseudonymizer,
+                           line_buffered=args.linebuffered)
     scrubber.anonymize()
+    if args.stats:
+        sys.stderr.write(scrubber.report() + '\n')
+    elif scrubber.cache is not None:
+        sys.stderr.write(scrubber.cache.report() + '\n')
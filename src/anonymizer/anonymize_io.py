@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# Copyright (c) 2014, Stanford University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+Opening scrubber input and output, with transparent compression.
+'''
+
+import bz2
+import gzip
+import io
+import locale
+import lzma
+import os
+import queue
+import sys
+import threading
+
+# Supported compression formats:
+COMPRESSIONS = ('gzip', 'bz2', 'xz', 'zstd')
+
+# File name extension --> compression format:
+EXTENSIONS = {'.gz'   : 'gzip',
+              '.gzip' : 'gzip',
+              '.bz2'  : 'bz2',
+              '.xz'   : 'xz',
+              '.lzma' : 'xz',
+              '.zst'  : 'zstd',
+              '.zstd' : 'zstd'
+              }
+
+# Bytes read or written at a time:
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+# Same as the gzip command; level 9 costs much more time for little gain:
+GZIP_LEVEL = 6
+
+def compression_for(file_name, compression=None):
+    '''
+    Decide how a file is compressed.
+
+    :param file_name: file name, or None for STDIN/STDOUT
+    :type file_name: String
+    :param compression: one of COMPRESSIONS, or 'none'; default
+        is to go by the extension of file_name
+    :type compression: String
+    :returns: one of COMPRESSIONS, or None if not compressed
+    :rtype: String
+    :raises ValueError: for an unknown compression format
+    '''
+    if compression is None:
+        if file_name is None:
+            return None
+        return EXTENSIONS.get(os.path.splitext(file_name)[1].lower())
+    if compression == 'none':
+        return None
+    if compression not in COMPRESSIONS:
+        raise ValueError("Compression must be one of %s or 'none', but was '%s'" % (', '.join(COMPRESSIONS), compression))
+    return compression
+
+def open_text(file_name, mode, compression=None, newline=None, threaded=False, buffer_size=DEFAULT_BUFFER_SIZE):
+    '''
+    Open a file, or STDIN/STDOUT, for reading or writing text,
+    compressed as given. Close with close_text().
+
+    :param file_name: file to open; None for STDIN or STDOUT
+    :type file_name: String
+    :param mode: 'r' or 'w'
+    :type mode: String
+    :param compression: one of COMPRESSIONS, or None
+    :type compression: String
+    :param newline: as for open()
+    :type newline: String
+    :param threaded: whether to (de)compress in a separate thread,
+        so that it overlaps with scrubbing
+    :type threaded: bool
+    :param buffer_size: bytes read or written at a time
+    :type buffer_size: int
+    :rtype: text file
+    :raises ValueError: if compression is 'zstd', and no zstd module is installed
+    '''
+    reading = mode == 'r'
+    if compression is None:
+        if file_name is None:
+            return sys.stdin if reading else sys.stdout
+        return open(file_name, mode, buffering=buffer_size, newline=newline)
+    if file_name is None:
+        target = sys.stdin.buffer if reading else sys.stdout.buffer
+    else:
+        target = file_name
+    binary = open_binary(target, mode + 'b', compression)
+    if reading:
+        buffered = io.BufferedReader(ThreadedReader(binary, buffer_size) if threaded else binary, buffer_size)
+    else:
+        buffered = io.BufferedWriter(ThreadedWriter(binary) if threaded else binary, buffer_size)
+    return io.TextIOWrapper(buffered, encoding=locale.getpreferredencoding(False), newline=newline)
+
+def close_text(fd):
+    '''
+    Close a file opened by open_text(). STDIN and
+    STDOUT are left open; STDOUT is flushed.
+
+    :param fd: file to close; None is ignored
+    :type fd: file
+    '''
+    if fd is None or fd is sys.stdin:
+        return
+    if fd is sys.stdout:
+        fd.flush()
+    else:
+        fd.close()
+
+def open_binary(target, mode, compression):
+    '''
+    Open a compressed file for binary reading or writing. A file
+    object passed as target is not closed with the returned file.
+
+    :param target: file name, or binary file object
+    :type target: String or file
+    :param mode: 'rb' or 'wb'
+    :type mode: String
+    :param compression: one of COMPRESSIONS
+    :type compression: String
+    :rtype: binary file
+    '''
+    if compression == 'gzip':
+        return gzip.open(target, mode, compresslevel=GZIP_LEVEL)
+    if compression == 'bz2':
+        return bz2.open(target, mode)
+    if compression == 'xz':
+        return lzma.open(target, mode)
+    # Python 3.14 comes with zstd; before that it takes the zstandard package:
+    try:
+        from compression import zstd
+        return zstd.open(target, mode)
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("zstd compression needs Python 3.14, or the zstandard package")
+    owned = isinstance(target, (str, bytes, os.PathLike))
+    fd = open(target, mode) if owned else target
+    if mode == 'rb':
+        return zstandard.ZstdDecompressor().stream_reader(fd, read_across_frames=True, closefd=owned)
+    return zstandard.ZstdCompressor().stream_writer(fd, closefd=owned)
+
+class ThreadedReader(io.RawIOBase):
+    '''
+    Reads a file in a background thread, a chunk ahead of the reader.
+    For a compressed file, decompression then overlaps with scrubbing:
+    the zlib, bz2 and lzma modules release the GIL while they work.
+    '''
+
+    # Chunks read ahead:
+    MAX_CHUNKS = 4
+
+    def __init__(self, fd, chunk_size):
+        '''
+        :param fd: binary file to read; closed with this one
+        :type fd: file
+        :param chunk_size: bytes to read at a time
+        :type chunk_size: int
+        '''
+        io.RawIOBase.__init__(self)
+        self.fd = fd
+        self.chunks = queue.Queue(ThreadedReader.MAX_CHUNKS)
+        self.chunk = memoryview(b'')
+        self.eof = False
+        self.error = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._read_chunks, args=(chunk_size,), daemon=True)
+        self.thread.start()
+
+    def _read_chunks(self, chunk_size):
+        try:
+            while True:
+                chunk = self.fd.read(chunk_size)
+                if not self._put(chunk) or not chunk:
+                    return
+        except Exception as e:
+            self.error = e
+            self._put(b'')
+
+    def _put(self, chunk):
+        # Give up if the reader is closed, rather than wait forever:
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(chunk, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while not self.chunk:
+            if self.eof:
+                return 0
+            self.chunk = memoryview(self.chunks.get())
+            if not self.chunk:
+                self.eof = True
+                if self.error is not None:
+                    raise self.error
+        num_bytes = min(len(buf), len(self.chunk))
+        buf[:num_bytes] = self.chunk[:num_bytes]
+        self.chunk = self.chunk[num_bytes:]
+        return num_bytes
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.fd.close()
+        io.RawIOBase.close(self)
+
+class ThreadedWriter(io.RawIOBase):
+    '''
+    Writes to a file in a background thread. For a compressed file,
+    compression then overlaps with scrubbing. Errors in the background
+    thread are raised by the next write(), or by close().
+    '''
+
+    # Chunks waiting to be written:
+    MAX_CHUNKS = 4
+
+    def __init__(self, fd):
+        '''
+        :param fd: binary file to write; closed with this one
+        :type fd: file
+        '''
+        io.RawIOBase.__init__(self)
+        self.fd = fd
+        self.chunks = queue.Queue(ThreadedWriter.MAX_CHUNKS)
+        self.error = None
+        self.thread = threading.Thread(target=self._write_chunks, daemon=True)
+        self.thread.start()
+
+    def _write_chunks(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            # After an error, keep taking chunks, so that writers don't block:
+            if self.error is None:
+                try:
+                    self.fd.write(chunk)
+                except Exception as e:
+                    self.error = e
+
+    def writable(self):
+        return True
+
+    def write(self, buf):
+        if self.error is not None:
+            raise self.error
+        self.chunks.put(bytes(buf))
+        return len(buf)
+
+    def close(self):
+        if self.closed:
+            return
+        self.chunks.put(None)
+        self.thread.join()
+        try:
+            self.fd.close()
+        finally:
+            io.RawIOBase.close(self)
+        if self.error is not None:
+            raise self.error
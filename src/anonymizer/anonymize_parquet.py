@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# Copyright (c) 2014, Stanford University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+Column-at-a-time scrubbing of Parquet files. Needs the pyarrow package.
+'''
+
+import argparse
+import os
+import re
+import sys
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from anonymize_csv import parse_profile
+from anonymize_names import NameDictionary
+from anonymize_txt import TextScrubber, DETECTOR_NAMES, canonical_detectors, get_engine
+
+
+class ParquetScrubber(TextScrubber):
+    '''
+    Scrubs the string columns of a Parquet file, one Arrow record batch
+    and one column at a time, and writes a Parquet file with the same
+    schema.
+
+    Columns that are not strings, and ignored columns, are passed
+    through as they are, without copying. In a string column, Arrow
+    picks out the cells that contain an ASCII gate character of one of
+    the detectors, such as a digit or an @, or any non-ASCII character,
+    which may be a non-ASCII digit. Only those cells are scrubbed by
+    anonymize_text(); the others are left in place. Dictionary
+    encoded columns are read as such, and only their dictionary of
+    distinct values is scrubbed.
+
+    Strings nested in list or struct columns are not scrubbed.
+    '''
+
+    # Rows per Arrow record batch:
+    DEFAULT_BATCH_SIZE = 65536
+
+    # Parquet compression of the output:
+    DEFAULT_CODEC = 'snappy'
+
+    # Cells are scrubbed column by column, so there are no rows to count:
+    ROW_PER_FIELD = False
+
+    def __init__(self, input_file, output_file, ignore_cols=(), profile=None,
+                 batch_size=DEFAULT_BATCH_SIZE, codec=DEFAULT_CODEC, names=None, pseudonymizer=None):
+        '''
+        :param input_file: Parquet file to scrub
+        :type input_file: String
+        :param output_file: Parquet file to write
+        :type output_file: String
+        :param ignore_cols: names or indexes of columns not to scrub
+        :type ignore_cols: [int|String]
+        :param profile: column name or index --> detectors to run on the
+            column; columns not in the profile get all detectors
+        :type profile: {int|String : (String)}
+        :param batch_size: number of rows scrubbed at a time
+        :type batch_size: int
+        :param codec: Parquet compression of the output, such as
+            'snappy', 'zstd', or 'none'
+        :type codec: String
+        :param names: names to redact; default is to redact no names
+        :type names: NameDictionary
+        :param pseudonymizer: replaces detector hits by stable tokens
+        :type pseudonymizer: Pseudonymizer
+        :raises ValueError: if pyarrow is not installed
+        '''
+        if pyarrow is None:
+            raise ValueError("Parquet scrubbing needs the pyarrow package")
+        TextScrubber.__init__(self, input_file, output_file, names=names, pseudonymizer=pseudonymizer)
+        self.ignore_cols = set(ignore_cols)
+        self.profile = {col : canonical_detectors(detectors) for col, detectors in (profile or {}).items()}
+        if batch_size < 1:
+            raise ValueError("Batch size must be at least 1, but was %s" % batch_size)
+        self.batch_size = batch_size
+        self.codec = codec
+
+    def anonymize(self):
+        '''
+        Scrub the input file, and write the output file.
+        '''
+        schema = pyarrow.parquet.read_schema(self.infile_name)
+        engines = self.column_engines(schema)
+        dictionary_cols = [schema.field(i).name for i in engines]
+        parquet_file = pyarrow.parquet.ParquetFile(self.infile_name, read_dictionary=dictionary_cols)
+        # Column index --> (dictionary, scrubbed dictionary) of the last
+        # batch. Batches of one row group share the same dictionary:
+        dictionaries = {}
+        with pyarrow.parquet.ParquetWriter(self.outfile_name, schema, compression=self.codec) as writer:
+            for batch in parquet_file.iter_batches(batch_size=self.batch_size):
+                columns = []
+                for i, column in enumerate(batch.columns):
+                    engine = engines.get(i)
+                    if engine is None:
+                        columns.append(column)
+                        continue
+                    if pyarrow.types.is_dictionary(column.type):
+                        dictionary, scrubbed = dictionaries.get(i, (None, None))
+                        if dictionary is None or not column.dictionary.equals(dictionary):
+                            dictionary = column.dictionary
+                            scrubbed = self.scrub_column(dictionary, engine)
+                            dictionaries[i] = (dictionary, scrubbed)
+                        column = pyarrow.DictionaryArray.from_arrays(column.indices, scrubbed)
+                        columns.append(column.cast(schema.field(i).type))
+                    else:
+                        columns.append(self.scrub_column(column, engine))
+                writer.write_batch(pyarrow.RecordBatch.from_arrays(columns, schema=schema))
+
+    def column_engines(self, schema):
+        '''
+        Decide which columns are scrubbed, and by which detectors.
+
+        :param schema: schema of the input
+        :type schema: pyarrow.Schema
+        :returns: column index --> RedactionEngine, for the
+            string columns to scrub
+        :rtype: {int : RedactionEngine}
+        :raises ValueError: if a profiled or ignored column is not in the schema
+        '''
+        for col in set(self.profile) | self.ignore_cols:
+            if isinstance(col, int) and not 0 <= col < len(schema) or not isinstance(col, int) and col not in schema.names:
+                raise ValueError("Column '%s' is not in the Parquet schema" % col)
+        engines = {}
+        for i, field in enumerate(schema):
+            if i in self.ignore_cols or field.name in self.ignore_cols:
+                continue
+            value_type = field.type.value_type if pyarrow.types.is_dictionary(field.type) else field.type
+            if not (pyarrow.types.is_string(value_type) or pyarrow.types.is_large_string(value_type)):
+                continue
+            detectors = self.profile.get(field.name, self.profile.get(i, DETECTOR_NAMES))
+            engines[i] = get_engine(detectors)
+        return engines
+
+    def scrub_column(self, column, engine):
+        '''
+        Scrub the cells of a string column.
+
+        :param column: column to scrub
+        :type column: pyarrow.Array
+        :param engine: engine with the detectors to run
+        :type engine: RedactionEngine
+        :returns: scrubbed column of the same type
+        :rtype: pyarrow.Array
+        '''
+        if self.names is None:
+            # Cells without any gate character are left alone; names, if
+            # any, can be anywhere. Arrow's regexes do not know Python's
+            # Unicode classes, so cells with non-ASCII characters are left
+            # to the gates of anonymize_text():
+            gate_chars = ''.join(chars for chars, _gate, _detectors in engine.gates)
+            if not gate_chars:
+                return column
+            mask = pyarrow.compute.match_substring_regex(column, r'[%s]|[^\x00-\x7f]' % re.escape(gate_chars))
+            mask = pyarrow.compute.fill_null(mask, False)
+        else:
+            mask = pyarrow.compute.is_valid(column)
+        num_cells = pyarrow.compute.sum(mask).as_py() or 0
+        if self.names is None:
+            for name in engine.detectors:
+                self.skipped_detectors[name] += len(column) - column.null_count - num_cells
+        if num_cells == 0:
+            return column
+        texts = pyarrow.compute.filter(column, mask).to_pylist()
+        scrubbed = pyarrow.array([self.anonymize_text(text, engine) for text in texts], type=column.type)
+        return pyarrow.compute.replace_with_mask(column, mask, scrubbed)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]), formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('-i', '--infile',
+                        action='store',
+                        required=True,
+                        help="Parquet file to scrub"
+                        )
+    parser.add_argument('-o', '--outfile',
+                        action='store',
+                        required=True,
+                        help="Parquet file to which scrubbed content is to be written"
+                        )
+    parser.add_argument('-c', '--ignorecol',
+                        action='store',
+                        nargs='*',
+                        help="Names or indexes (origin 0) of columns to ignore; default: scrub all string columns.",
+                        default=[]
+                        )
+    parser.add_argument('-p', '--profile',
+                        action='store',
+                        nargs='*',
+                        help="Detectors to run on a column, as <column>=<detector>,<detector>...\n"
+                             "Columns are names or indexes as for --ignorecol.\n"
+                             "Detectors: %s. Unprofiled columns get all detectors." % ', '.join(DETECTOR_NAMES),
+                        default=[]
+                        )
+    parser.add_argument('-b', '--batchsize',
+                        action='store',
+                        type=int,
+                        help="Number of rows scrubbed at a time; default: %s" % ParquetScrubber.DEFAULT_BATCH_SIZE,
+                        default=ParquetScrubber.DEFAULT_BATCH_SIZE
+                        )
+    parser.add_argument('--codec',
+                        action='store',
+                        help="Parquet compression of outfile, such as snappy, zstd, gzip, or none; default: %s" % ParquetScrubber.DEFAULT_CODEC,
+                        default=ParquetScrubber.DEFAULT_CODEC
+                        )
+    parser.add_argument('-n', '--names',
+                        action='store',
+                        help="File with names to redact, one per line. The lookup tables built from\n"
+                             "it are kept in <file>.trie, and rebuilt when the file changes.",
+                        default=None
+                        )
+
+    args = parser.parse_args();
+
+    try:
+        profile = parse_profile(args.profile)
+    except ValueError as e:
+        print("Bad column profile: %s" % str(e))
+        sys.exit()
+
+    scrubber = ParquetScrubber(args.infile,
+                               args.outfile,
+                               ignore_cols=[int(col) if col.isdigit() else col for col in args.ignorecol],
+                               profile=profile,
+                               batch_size=args.batchsize,
+                               codec=args.codec,
+                               names=NameDictionary.load_or_build(args.names) if args.names is not None else None)
+    scrubber.anonymize()
@@ -0,0 +1,470 @@
+#!/usr/bin/env python
+# Copyright (c) 2014, Stanford University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+Long-running scrubbing server on a Unix domain socket. Clients, such
+as anonymize_client.py, send text or CSV, and get the scrubbed result
+back as it is produced; see anonymize_client.py for the protocol.
+
+The detectors are compiled once, when the server starts, rather than
+on every run of anonymize_txt.py or anonymize_csv.py.
+'''
+
+import argparse
+import asyncio
+import codecs
+import concurrent.futures
+import csv
+import io
+import json
+import os
+import re
+import socket
+import stat
+import sys
+import threading
+
+from anonymize_checkpoint import CompleteRecords
+from anonymize_client import HEADER, DATA, END, ERROR, FRAME_HEADER, MAX_FRAME_SIZE, DEFAULT_SOCKET
+from anonymize_csv import CSVScrubber, parse_profile, format_csv
+from anonymize_names import NameDictionary
+from anonymize_txt import TextScrubber, LRUCache, get_engine
+
+class ScrubServer(object):
+    '''
+    Serves scrub requests on a Unix domain socket, any number at a
+    time. Input is cut into chunks of complete lines, or of complete
+    records for CSV, and the chunks are scrubbed in a pool of worker
+    processes, or in a worker thread if there is one worker. Each
+    request has at most MAX_CHUNKS_IN_FLIGHT chunks in the pool, and
+    gets its results back in input order.
+
+    The socket is only accessible to the user running the server, and
+    lives in a directory that other users cannot write to, so that they
+    cannot put a socket of their own in its place.
+    '''
+
+    # Characters of input per chunk:
+    DEFAULT_CHUNK_SIZE = 256 * 1024
+
+    # Chunks of one request being scrubbed or waiting to be sent:
+    MAX_CHUNKS_IN_FLIGHT = 4
+
+    # Characters of a line or CSV record, beyond which the request is
+    # refused rather than buffered further, as with an unbalanced quote:
+    DEFAULT_MAX_RECORD_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, workers=1, names=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 max_record_size=DEFAULT_MAX_RECORD_SIZE):
+        '''
+        :param socket_path: Unix domain socket to listen on
+        :type socket_path: String
+        :param workers: number of processes that scrub in parallel
+        :type workers: int
+        :param names: names to redact in all requests; default is to redact no names
+        :type names: NameDictionary
+        :param chunk_size: characters of input scrubbed at a time
+        :type chunk_size: int
+        :param max_record_size: characters of the longest line or
+            CSV record accepted
+        :type max_record_size: int
+        '''
+        if workers < 1:
+            raise ValueError("Number of workers must be at least 1, but was %s" % workers)
+        self.socket_path = socket_path
+        self.workers = workers
+        self.names = names
+        self.chunk_size = chunk_size
+        self.max_record_size = max_record_size
+        # Set once the server accepts connections:
+        self.started = threading.Event()
+        self.loop = None
+        self.stopped = None
+        self.executor = None
+
+    def run(self):
+        '''
+        Serve requests until stop() is called.
+        '''
+        asyncio.run(self.serve())
+
+    def stop(self):
+        '''
+        Stop serving. May be called from any thread.
+        '''
+        self.loop.call_soon_threadsafe(self.stopped.set)
+
+    async def serve(self):
+        '''
+        Serve requests until stop() is called.
+        '''
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        if self.workers > 1:
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.names,))
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(1, initializer=_init_worker, initargs=(self.names,))
+        self.prepare_directory()
+        self.remove_stale_socket()
+        # The socket is created with mode 0600, rather than changed to it:
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self.handle, path=self.socket_path)
+        finally:
+            os.umask(umask)
+        try:
+            self.started.set()
+            async with server:
+                await self.stopped.wait()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def prepare_directory(self):
+        '''
+        Create the directory of the socket with mode 0700 if it does
+        not exist, and make sure that no other user can write to it.
+
+        :raises ValueError: if another user owns the directory, or can write to it
+        '''
+        directory = os.path.dirname(os.path.abspath(self.socket_path))
+        try:
+            os.mkdir(directory, 0o700)
+        except FileExistsError:
+            pass
+        info = os.lstat(directory)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o022:
+            raise ValueError("Socket directory %s must be a directory of yours that others cannot write to" % directory)
+
+    def remove_stale_socket(self):
+        '''
+        Remove a socket file left behind by a server that is gone.
+
+        :raises ValueError: if a server is still listening on it, or
+            the path is not a socket
+        '''
+        try:
+            info = os.lstat(self.socket_path)
+        except FileNotFoundError:
+            return
+        # Connecting to a plain file is refused just like a stale socket:
+        if not stat.S_ISSOCK(info.st_mode):
+            raise ValueError("%s exists, and is not a socket" % self.socket_path)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(self.socket_path)
+            return
+        finally:
+            probe.close()
+        raise ValueError("A server is already listening on %s" % self.socket_path)
+
+    async def handle(self, reader, writer):
+        '''
+        Serve one request.
+        '''
+        try:
+            kind, payload = await _read_frame(reader)
+            if kind != HEADER:
+                raise ValueError("Request must start with a header frame")
+            request = json.loads(payload.decode('utf-8'))
+            encoding = request.pop('encoding', 'utf-8')
+            # Check the request, before any data comes in:
+            make_scrubber(request, self.names)
+            codecs.lookup(encoding)
+
+            results = asyncio.Queue(ScrubServer.MAX_CHUNKS_IN_FLIGHT)
+            reading = asyncio.ensure_future(self.read_chunks(reader, request, encoding, results))
+            sending = asyncio.ensure_future(_send_results(writer, encoding, results))
+            try:
+                await asyncio.wait((reading, sending), return_when=asyncio.FIRST_EXCEPTION)
+                for task in (reading, sending):
+                    if task.done() and task.exception() is not None:
+                        raise task.exception()
+                await sending
+            finally:
+                reading.cancel()
+                sending.cancel()
+            await _write_frame(writer, END)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # Client went away
+            pass
+        except Exception as e:
+            try:
+                await _write_frame(writer, ERROR, str(e).encode('utf-8'))
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def read_chunks(self, reader, request, encoding, results):
+        '''
+        Read the input of a request, and queue up the scrubbing of each
+        chunk in the executor. None is queued at the end.
+        '''
+        decoder = codecs.getincrementaldecoder(encoding)()
+        # JSON of the request identifies the scrubber in the workers:
+        key = json.dumps(request, sort_keys=True)
+        splitter = ChunkSplitter(request['kind'] == 'csv', bool(request.get('streaming', False)),
+                                 self.chunk_size, self.max_record_size)
+        while True:
+            kind, payload = await _read_frame(reader)
+            if kind == END:
+                splitter.add(decoder.decode(b'', final=True))
+                chunk = splitter.take_all()
+                if chunk:
+                    await results.put(self.loop.run_in_executor(self.executor, _scrub_chunk, key, chunk))
+                await results.put(None)
+                return
+            if kind != DATA:
+                raise ValueError("Expected a data or end frame")
+            splitter.add(decoder.decode(payload))
+            chunk = splitter.take()
+            if chunk:
+                await results.put(self.loop.run_in_executor(self.executor, _scrub_chunk, key, chunk))
+
+class ChunkSplitter(object):
+    '''
+    Collects the decoded input of a request, and cuts it into chunks
+    that end after a complete line, or for CSV, after a complete record
+    as csv.reader parses it. A quote inside an unquoted cell is text to
+    csv.reader, so records cannot be told apart by counting quotes.
+
+    The input is only searched for a place to cut once at least
+    chunk_size characters are waiting, and after a search, not again
+    until the input left over has doubled. Each character is thus
+    searched a bounded number of times, even in a record that spans
+    many frames.
+    '''
+
+    def __init__(self, is_csv, streaming, chunk_size, max_record_size):
+        '''
+        :param is_csv: whether the input is CSV
+        :type is_csv: bool
+        :param streaming: whether CSV line endings are kept, as by
+            CSVScrubber in streaming mode
+        :type streaming: bool
+        :param chunk_size: characters of input per chunk
+        :type chunk_size: int
+        :param max_record_size: characters of the longest line or
+            record accepted
+        :type max_record_size: int
+        '''
+        self.is_csv = is_csv
+        self.streaming = streaming
+        self.chunk_size = chunk_size
+        self.max_record_size = max_record_size
+        # Input not yet taken, and its number of characters:
+        self.pieces = []
+        self.size = 0
+        # Size at which to search for a place to cut next:
+        self.next_search = chunk_size
+
+    def add(self, text):
+        '''
+        Add a piece of input.
+
+        :param text: decoded input
+        :type text: String
+        '''
+        if text:
+            self.pieces.append(text)
+            self.size += len(text)
+
+    def take(self):
+        '''
+        If enough input is waiting, return its complete lines or
+        records, and keep the rest. Otherwise return ''.
+
+        :rtype: String
+        :raises ValueError: if a line or record grows beyond max_record_size
+        '''
+        if self.size < self.next_search:
+            return ''
+        text = ''.join(self.pieces)
+        end = self.chunk_end(text)
+        rest = text[end:]
+        self.pieces = [rest] if rest else []
+        self.size = len(rest)
+        self.next_search = max(self.chunk_size, 2 * len(rest))
+        if len(rest) > self.max_record_size:
+            raise ValueError("No end of %s in %s characters of input%s" %
+                             (('record', len(rest), '; is a quote unbalanced?') if self.is_csv else ('line', len(rest), '')))
+        return text[:end]
+
+    def take_all(self):
+        '''
+        Return all input added so far, complete or not.
+
+        :rtype: String
+        '''
+        chunk = ''.join(self.pieces)
+        self.pieces = []
+        self.size = 0
+        self.next_search = self.chunk_size
+        return chunk
+
+    def chunk_end(self, text):
+        '''
+        Find where text can be cut: after its last complete line, or for
+        CSV after its last complete record. text starts at the start of
+        a line or record.
+
+        :param text: input not yet taken
+        :type text: String
+        :returns: end of the last complete line or record; 0 if none
+        :rtype: int
+        '''
+        if not self.is_csv or '"' not in text:
+            # Every line end is a record end. A final \r may be the
+            # first half of a \r\n:
+            return max(text.rfind('\n'), text.rfind('\r', 0, len(text) - 1)) + 1
+        lines = TextLines(text, self.streaming)
+        records = CompleteRecords(csv.reader(lines), lines)
+        for _record in records:
+            pass
+        return records.offset
+
+class TextLines(object):
+    '''
+    Iterates over the complete lines of a string, as _scrub_chunk()
+    hands them to csv.reader, with the offset and exhausted attributes
+    of CompleteLines. Without streaming, line endings are turned into
+    spaces, as CSVScrubber does.
+    '''
+
+    def __init__(self, text, streaming):
+        '''
+        :param text: text to split into lines
+        :type text: String
+        :param streaming: whether to keep line endings
+        :type streaming: bool
+        '''
+        self.text = text
+        self.lines = io.StringIO(text, newline='')
+        self.streaming = streaming
+        self.offset = 0
+        self.exhausted = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.lines.readline()
+        end = self.offset + len(line)
+        # A final \r may be the first half of a \r\n:
+        if not line.endswith(('\n', '\r')) or end == len(self.text) and line.endswith('\r'):
+            self.exhausted = True
+            raise StopIteration
+        self.offset = end
+        return line if self.streaming else re.sub(TextScrubber.CR_LF_PATTERN, ' ', line)
+
+def make_scrubber(request, names):
+    '''
+    Build the scrubber for a request.
+
+    :param request: request options; see anonymize_client.scrub()
+    :type request: {String : object}
+    :param names: names to redact
+    :type names: NameDictionary
+    :rtype: TextScrubber
+    :raises ValueError: for bad request options
+    '''
+    kind = request.get('kind')
+    if kind == 'txt':
+        return TextScrubber(names=names)
+    if kind == 'csv':
+        profile = parse_profile(request.get('profile', []))
+        if any(not isinstance(col, int) for col in profile):
+            raise ValueError("The scrubbing server takes column indexes, not header names, in profiles")
+        return CSVScrubber(ignore_cols=request.get('ignore_cols', []),
+                           streaming=bool(request.get('streaming', False)),
+                           profile=profile,
+                           names=names)
+    raise ValueError("Request kind must be 'txt' or 'csv', but was '%s'" % kind)
+
+# Scrubbers kept by each worker, for the most recent distinct requests:
+MAX_WORKER_SCRUBBERS = 64
+
+# Names to redact, and request JSON --> scrubber, in each worker:
+_worker_names = None
+_worker_scrubbers = LRUCache(MAX_WORKER_SCRUBBERS)
+
+def _init_worker(names):
+    global _worker_names
+    _worker_names = names
+    # Compile the detectors now, rather than on the first request:
+    get_engine()
+
+def _scrub_chunk(key, text):
+    scrubber = _worker_scrubbers.get(key)
+    if scrubber is None:
+        scrubber = make_scrubber(json.loads(key), _worker_names)
+        _worker_scrubbers.put(key, scrubber)
+    if not isinstance(scrubber, CSVScrubber):
+        # Universal newlines, as when anonymize_txt.py reads a file:
+        return scrubber.scrub_lines(io.StringIO(text, newline=None))
+    if scrubber.streaming:
+        lines = io.StringIO(text, newline='')
+    else:
+        lines = (re.sub(TextScrubber.CR_LF_PATTERN, ' ', line) for line in io.StringIO(text, newline=None))
+    return format_csv(scrubber.scrub_batch(list(csv.reader(lines))))
+
+async def _send_results(writer, encoding, results):
+    while True:
+        result = await results.get()
+        if result is None:
+            return
+        await _write_frame(writer, DATA, (await result).encode(encoding))
+
+async def _read_frame(reader):
+    kind, size = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if size > MAX_FRAME_SIZE:
+        raise ValueError("Frame of %s bytes exceeds the maximum of %s" % (size, MAX_FRAME_SIZE))
+    return kind, await reader.readexactly(size)
+
+async def _write_frame(writer, kind, payload=b''):
+    writer.write(FRAME_HEADER.pack(kind, len(payload)))
+    if payload:
+        writer.write(payload)
+    await writer.drain()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]), formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('-s', '--socket',
+                        action='store',
+                        help="Unix domain socket to listen on; default: %s" % DEFAULT_SOCKET,
+                        default=DEFAULT_SOCKET
+                        )
+    parser.add_argument('-w', '--workers',
+                        action='store',
+                        type=int,
+                        help="Number of processes that scrub in parallel; default: 1",
+                        default=1
+                        )
+    parser.add_argument('-n', '--names',
+                        action='store',
+                        help="File with names to redact, one per line. The lookup tables built from\n"
+                             "it are kept in <file>.trie, and rebuilt when the file changes.",
+                        default=None
+                        )
+
+    args = parser.parse_args();
+
+    names = NameDictionary.load_or_build(args.names) if args.names is not None else None
+    server = ScrubServer(args.socket, workers=args.workers, names=names)
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
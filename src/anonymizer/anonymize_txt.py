@@ -15,9 +15,489 @@ Created on Dec 13, 2017
 '''
 
 import argparse
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import heapq
+import hmac
+import io
+import itertools
+import locale
+import multiprocessing
 import os
 import re
 import sys
+import time
+
+from anonymize_checkpoint import Checkpoint, complete_size
+from anonymize_io import COMPRESSIONS, DEFAULT_BUFFER_SIZE, compression_for, open_text, close_text
+from anonymize_names import NameDictionary
+
+# Regex from stackoverflow. Seems to do an awesome job at capturing
+# all phone nos :)
+PHONE_PATTERN = r'(?:(?:\+?1\s*(?:[.-]\s*)?)?(?:\(\s*(?:[2-9]1[02-9]|[2-9][02-8]1|[2-9][02-8][02-9])\s*\)|(?:[2-9]1[02-9]|[2-9][02-8]1|[2-9][02-8][02-9]))\s*(?:[.-]\s*)?)?(?:[2-9]1[02-9]|[2-9][02-9]1|[2-9][02-9]{2})\s*(?:[.-]\s*)?[0-9]{4}(?:\s*(?:#|x\.?|ext\.?|extension)\s*\d+)?'
+
+# Zipcodes, optionally zip+4:
+ZIP_PATTERN = r'\d{5}(?:[-\s]\d{4})?'
+
+# Zipcodes in engines that also run the phone detector. Phone numbers
+# take precedence: a zipcode does not match if a phone number starts
+# within its digits. Without the phone detector, such digits are left
+# to ZIP_PATTERN, as prune_zipcode() always did:
+ZIP_AFTER_PHONE_PATTERN = r'(?!\d{1,4}%s)\d{5}(?:[-\s](?!\d{0,3}%s)\d{4})?' % (PHONE_PATTERN, PHONE_PATTERN)
+
+# Pattern for email id - strings of alphabets/numbers/dots/hyphens
+# at the start of the text or of a word, followed by an @, followed by
+# combinations of dot/. followed by the edu/com. Trailing spaces are
+# swallowed. Matches only start at word starts, and neither the local
+# part nor the domain can run across whitespace or an @. Backtracking
+# is thus confined to a single word, and the cost stays linear in the
+# length of the text, even for long posts full of stray @ characters:
+EMAIL_PATTERN = r'(?<!\S)[a-zA-Z0-9\(\.\-]+@[a-zA-Z0-9\.]+.(?:edu|com)\s*'
+
+# Gate of the phone and zip detectors. Like the \d in ZIP_PATTERN, it
+# matches any Unicode decimal digit, such as fullwidth or Arabic-Indic
+# digits, not just 0-9:
+DIGITS = r'\d'
+
+# Detector name --> (pattern, replacement, gate). The gate is a regex
+# character class; a detector can only match text that contains at
+# least one character of its gate. The order matters: where two
+# detectors could match at the same position, the earlier one wins:
+DETECTORS = (('phone', PHONE_PATTERN, '<phoneRedac>',  DIGITS),
+             ('zip',   ZIP_PATTERN,   '<zipRedac>',    DIGITS),
+             ('email', EMAIL_PATTERN, '<emailRedac> ', '@'),
+             )
+
+DETECTOR_NAMES = tuple(detector[0] for detector in DETECTORS)
+
+class RedactionEngine(object):
+    '''
+    Merges a set of detectors into one compiled alternation, and
+    redacts a string in a single re.sub() pass. The callback looks
+    at which named group matched, and returns the corresponding
+    <xxxRedac> token.
+
+    Engines are expensive to build, and immutable once built. Obtain
+    them through get_engine(), which shares instances.
+    '''
+
+    def __init__(self, detectors=DETECTOR_NAMES):
+        '''
+        :param detectors: names of detectors to run; see DETECTOR_NAMES
+        :type detectors: (String)
+        '''
+        self.detectors = canonical_detectors(detectors)
+        self.replacements = {}
+        alternatives = []
+        # Gate --> detectors that need one of its characters:
+        gates = collections.OrderedDict()
+        for name, pattern, replacement, gate in DETECTORS:
+            if name in self.detectors:
+                if name == 'zip' and 'phone' in self.detectors:
+                    pattern = ZIP_AFTER_PHONE_PATTERN
+                alternatives.append('(?P<%s>%s)' % (name, pattern))
+                self.replacements[name] = replacement
+                gates[gate] = gates.get(gate, ()) + (name,)
+        # (ASCII characters of the gate, gate regex, detectors):
+        self.gates = tuple((ascii_chars(gate), re.compile('[%s]' % gate), detectors) for gate, detectors in gates.items())
+
+        # Detectors that passed their gates --> (engine, skipped detectors);
+        # filled in by gate() as combinations come up:
+        self.gated = {}
+
+        if alternatives:
+            self.pattern = re.compile('|'.join(alternatives))
+        else:
+            self.pattern = None
+
+    def redact(self, text, replace=None):
+        '''
+        Replace every detector hit in text by its redaction token.
+
+        :param text: text field
+        :type text: String
+        :param replace: function that returns the replacement for a
+            match, such as Pseudonymizer.replace(); default is the
+            <xxxRedac> token of the detector
+        :type replace: function
+        :returns: redacted text
+        :rtype: String
+        '''
+        if self.pattern is None:
+            return text
+        return self.pattern.sub(replace or self._replace, text)
+
+    def redact_count(self, text, replace=None):
+        '''
+        Like redact(), but also return the number of replacements made.
+
+        :rtype: (String, int)
+        '''
+        if self.pattern is None:
+            return text, 0
+        return self.pattern.subn(replace or self._replace, text)
+
+    def gate(self, text):
+        '''
+        Cheap pre-filter: find the detectors that could possibly match
+        text, judging by their gate characters. For ASCII text, checking
+        for a digit or an @ with the 'in' operator costs far less than a
+        regex search, and most fields contain neither. Other text is
+        searched with the gate regex, which also finds non-ASCII digits.
+
+        :param text: text field
+        :type text: String
+        :returns: the engine for just the detectors that could match,
+            and the names of the detectors that were skipped
+        :rtype: (RedactionEngine, (String))
+        '''
+        active = ()
+        is_ascii = text.isascii()
+        for chars, gate, detectors in self.gates:
+            if is_ascii:
+                for char in chars:
+                    if char in text:
+                        active += detectors
+                        break
+            elif gate.search(text) is not None:
+                active += detectors
+        try:
+            return self.gated[active]
+        except KeyError:
+            engine = self if len(active) == len(self.detectors) else get_engine(active)
+            skipped = tuple(name for name in self.detectors if name not in active)
+            result = self.gated[active] = (engine, skipped)
+            return result
+
+    def _replace(self, match):
+        return self.replacements[match.lastgroup]
+
+# Detector tuple --> RedactionEngine:
+_engines = {}
+
+def ascii_chars(char_class):
+    '''
+    The ASCII characters in a regex character class.
+
+    :param char_class: contents of a character class, such as r'\\d'
+    :type char_class: String
+    :rtype: String
+    '''
+    pattern = re.compile('[%s]' % char_class)
+    return ''.join(chr(code) for code in range(128) if pattern.match(chr(code)))
+
+def canonical_detectors(detectors):
+    '''
+    Check the given detector names, and return them as a tuple
+    in canonical detector order.
+
+    :param detectors: names of detectors; see DETECTOR_NAMES
+    :type detectors: (String)
+    :rtype: (String)
+    :raises ValueError: if a detector name is unknown
+    '''
+    unknown = set(detectors) - set(DETECTOR_NAMES)
+    if unknown:
+        raise ValueError("Unknown detector(s): %s" % ', '.join(sorted(unknown)))
+    return tuple(name for name in DETECTOR_NAMES if name in detectors)
+
+def get_engine(detectors=DETECTOR_NAMES):
+    '''
+    Return the (shared) RedactionEngine for the given detectors.
+
+    :param detectors: names of detectors to run; see DETECTOR_NAMES
+    :type detectors: (String)
+    :rtype: RedactionEngine
+    '''
+    key = canonical_detectors(detectors)
+    try:
+        return _engines[key]
+    except KeyError:
+        engine = _engines[key] = RedactionEngine(key)
+        return engine
+
+class LRUCache(object):
+    '''
+    Dict-like cache that holds at most max_size entries. When full,
+    adding an entry evicts the least recently used one. Keeps hit,
+    miss, and eviction counts.
+    '''
+
+    def __init__(self, max_size):
+        '''
+        :param max_size: maximum number of entries
+        :type max_size: int
+        '''
+        if max_size < 1:
+            raise ValueError("Cache size must be at least 1, but was %s" % max_size)
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        '''
+        Return the value cached for key, or default if there is none.
+        '''
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        '''
+        Cache value under key, evicting the least recently
+        used entry if the cache is full.
+        '''
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def take_counts(self):
+        '''
+        Return the (hits, misses, evictions) counted so far,
+        and start counting from zero.
+        '''
+        counts = (self.hits, self.misses, self.evictions)
+        self.hits = self.misses = self.evictions = 0
+        return counts
+
+    def add_counts(self, counts):
+        '''
+        Add (hits, misses, evictions) counted elsewhere, such
+        as by the cache of a worker process.
+        '''
+        hits, misses, evictions = counts
+        self.hits += hits
+        self.misses += misses
+        self.evictions += evictions
+
+    def report(self):
+        '''
+        Return a one-line summary of the counts.
+        '''
+        return "Cache: %s hits, %s misses, %s evictions" % (self.hits, self.misses, self.evictions)
+
+class Pseudonymizer(object):
+    '''
+    Replaces detector hits by stable tokens instead of <xxxRedac>, so
+    that records involving the same phone number, zipcode, or email
+    address can still be joined. A token holds the detector name and
+    the start of the keyed HMAC-SHA256 of the normalized value, as in
+    <email:3fa9c1d2e4b5>. Without the key, tokens cannot be traced back
+    to values by hashing guesses.
+
+    Values are normalized before hashing: emails are lower-cased, and
+    phone numbers and zipcodes reduced to their digits, minus a leading
+    US country code. So '(650) 327-7398' and '1-650-327-7398' get the
+    same token.
+
+    Tokens are a function of the key and the value alone, so worker
+    processes, and later runs with the same key, agree on them without
+    sharing any state. Tokens of recent values are kept in an LRUCache,
+    keyed by the text matched. Nothing is kept on disk: a table of
+    values and their tokens would be a list of the very data that
+    scrubbing removes.
+    '''
+
+    DEFAULT_TOKEN_LENGTH = 12
+    DEFAULT_CACHE_SIZE = 65536
+
+    def __init__(self, key, token_length=DEFAULT_TOKEN_LENGTH, cache_size=DEFAULT_CACHE_SIZE):
+        '''
+        :param key: secret HMAC key; the same key gives the same tokens
+        :type key: bytes
+        :param token_length: number of hex digits per token; short tokens
+            make different values more likely to share a token
+        :type token_length: int
+        :param cache_size: maximum number of cached tokens
+        :type cache_size: int
+        '''
+        if not key:
+            raise ValueError("Pseudonymization key must not be empty")
+        if not 1 <= token_length <= 64:
+            raise ValueError("Token length must be between 1 and 64, but was %s" % token_length)
+        self.key = key
+        self.token_length = token_length
+        self.cache = LRUCache(cache_size)
+        # Detector name --> token format; the email token keeps
+        # the space that the email pattern swallows:
+        self.formats = {name : '<%s:%%s>%s' % (name, replacement[len(replacement.rstrip()):])
+                        for name, _pattern, replacement, _gate in DETECTORS}
+
+    def replace(self, match):
+        '''
+        Callback for RedactionEngine.redact(): return the token
+        for a detector hit.
+
+        :param match: match of a RedactionEngine pattern
+        :type match: re.Match
+        :rtype: String
+        '''
+        name = match.lastgroup
+        value = match.group()
+        digest = self.cache.get((name, value))
+        if digest is None:
+            digest = self.digest(name, value)
+            self.cache.put((name, value), digest)
+        return self.formats[name] % digest
+
+    def digest(self, name, value):
+        '''
+        Return the token digest of a value found by a detector.
+
+        :param name: detector name
+        :type name: String
+        :param value: text the detector matched
+        :type value: String
+        :rtype: String
+        '''
+        if name == 'email':
+            normalized = value.strip().lower()
+        else:
+            normalized = ''.join(char for char in value if char.isdigit())
+            if name == 'phone' and len(normalized) == 11 and normalized.startswith('1'):
+                normalized = normalized[1:]
+        normalized = name + ':' + normalized
+        return hmac.new(self.key, normalized.encode('utf-8'), hashlib.sha256).hexdigest()[:self.token_length]
+
+    def take_counts(self):
+        '''
+        Return the cache counts so far, and start over. Worker
+        processes use this to send them to the main process.
+
+        :rtype: (int, int, int)
+        '''
+        return self.cache.take_counts()
+
+    def add_counts(self, counts):
+        '''
+        Add cache counts obtained from take_counts().
+        '''
+        self.cache.add_counts(counts)
+
+    def report(self):
+        '''
+        Return a one-line summary of the cache counts.
+        '''
+        cache = self.cache
+        return "Pseudonym cache: %s hits, %s misses, %s evictions" % (cache.hits, cache.misses, cache.evictions)
+
+class RunStats(object):
+    '''
+    Opt-in profile of a scrubbing run. For each detector: the number
+    of fields it ran on, and the seconds, matches, and UTF-8 bytes in
+    and out of running it on those fields by itself, as prune_numbers(),
+    prune_zipcode(), and prune_emails() do. Output still comes from
+    the combined single pass; the time of that pass is what ranks
+    the slowest fields.
+    '''
+
+    def __init__(self, num_slowest=10):
+        '''
+        :param num_slowest: number of slowest fields to remember
+        :type num_slowest: int
+        '''
+        self.num_slowest = num_slowest
+        # Detector name --> {'calls', 'seconds', 'matches', 'bytes_in', 'bytes_out'}:
+        self.detectors = {name : {'calls' : 0, 'seconds' : 0.0, 'matches' : 0, 'bytes_in' : 0, 'bytes_out' : 0}
+                          for name in DETECTOR_NAMES}
+        self.fields = 0
+        self.seconds = 0.0
+        # Heap of (seconds, row number) of the slowest fields:
+        self.slowest = []
+        # Number of the row being scrubbed, origin 1:
+        self.row_num = 0
+        self.engines = {name : get_engine((name,)) for name in DETECTOR_NAMES}
+
+    def profile(self, text, engine, replace=None):
+        '''
+        Redact text with engine, and record the statistics.
+
+        :param text: text field
+        :type text: String
+        :param engine: engine with the detectors to run
+        :type engine: RedactionEngine
+        :param replace: replacement function; see RedactionEngine.redact()
+        :type replace: function
+        :returns: redacted text
+        :rtype: String
+        '''
+        if engine.detectors:
+            bytes_in = len(text.encode('utf-8'))
+            for name in engine.detectors:
+                start_time = time.perf_counter()
+                redacted, matches = self.engines[name].redact_count(text, replace)
+                detector_stats = self.detectors[name]
+                detector_stats['seconds'] += time.perf_counter() - start_time
+                detector_stats['calls'] += 1
+                detector_stats['matches'] += matches
+                detector_stats['bytes_in'] += bytes_in
+                detector_stats['bytes_out'] += len(redacted.encode('utf-8'))
+
+        start_time = time.perf_counter()
+        text = engine.redact(text, replace)
+        seconds = time.perf_counter() - start_time
+
+        self.fields += 1
+        self.seconds += seconds
+        if len(self.slowest) < self.num_slowest:
+            heapq.heappush(self.slowest, (seconds, self.row_num))
+        elif self.slowest and seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, self.row_num))
+        return text
+
+    def merge(self, other):
+        '''
+        Add the statistics of a later part of the run, such as one
+        scrubbed by a worker process. Row numbers in other count from
+        the start of its part, and are shifted to follow our rows.
+
+        :param other: statistics to add
+        :type other: RunStats
+        '''
+        for name, detector_stats in other.detectors.items():
+            for key, value in detector_stats.items():
+                self.detectors[name][key] += value
+        self.fields += other.fields
+        self.seconds += other.seconds
+        for seconds, row_num in other.slowest:
+            heapq.heappush(self.slowest, (seconds, row_num + self.row_num))
+        while len(self.slowest) > self.num_slowest:
+            heapq.heappop(self.slowest)
+        self.row_num += other.row_num
+
+    def report(self):
+        '''
+        Return a human readable table of the statistics.
+
+        :rtype: String
+        '''
+        lines = ["%-8s %10s %10s %10s %14s %14s" % ('Detector', 'Calls', 'Seconds', 'Matches', 'Bytes in', 'Bytes out')]
+        for name in DETECTOR_NAMES:
+            detector_stats = self.detectors[name]
+            lines.append("%-8s %10d %10.4f %10d %14d %14d" % (name, 
+                                                              detector_stats['calls'], 
+                                                              detector_stats['seconds'],
+                                                              detector_stats['matches'],
+                                                              detector_stats['bytes_in'],
+                                                              detector_stats['bytes_out']))
+        lines.append("%s fields scrubbed in %.3f seconds; slowest fields:" % (self.fields, self.seconds))
+        for seconds, row_num in sorted(self.slowest, reverse=True):
+            lines.append("    row %s: %.6f seconds" % (row_num, seconds))
+        return '\n'.join(lines)
 
 class TextScrubber(object):
     '''
@@ -26,12 +506,102 @@ class TextScrubber(object):
 
     CR_LF_PATTERN = re.compile(r'[\n\r]')
 
-    def __init__(self, infile=None, outfile=None):
+    # Approximate number of input bytes a worker process scrubs at a time:
+    DEFAULT_SHARD_SIZE = 16 * 1024 * 1024
+
+    # Number of lines a worker process scrubs at a time when reading STDIN:
+    STDIN_BATCH_LINES = 10000
+
+    # Each anonymize_text() call scrubs one row. CSVScrubber, which
+    # scrubs a row cell by cell, counts rows in scrub_row() instead:
+    ROW_PER_FIELD = True
+
+    # Defaults for stream(): records per batch, batches in flight, and
+    # seconds to wait for more records before scrubbing a partial batch:
+    STREAM_BATCH_SIZE = 256
+    STREAM_CONCURRENCY = 2
+    STREAM_BATCH_TIMEOUT = 0.05
+
+    def __init__(self, infile=None, outfile=None, workers=1, shard_size=DEFAULT_SHARD_SIZE,
+                 collect_stats=False, num_slowest=10, names=None, checkpoint=None,
+                 in_compression=None, out_compression=None, io_threads=False, io_buffer_size=DEFAULT_BUFFER_SIZE,
+                 pseudonymizer=None, line_buffered=False):
         '''
         Constructor
+
+        :param infile: file to scrub; default is STDIN
+        :type infile: String
+        :param outfile: file to which scrubbed text is written; default is STDOUT
+        :type outfile: String
+        :param workers: number of processes that scrub in parallel
+        :type workers: int
+        :param shard_size: approximate number of bytes per shard when
+            scrubbing a file in parallel
+        :type shard_size: int
+        :param collect_stats: whether to profile the run; see RunStats
+        :type collect_stats: bool
+        :param num_slowest: number of slowest fields to report when profiling
+        :type num_slowest: int
+        :param names: names to redact; default is to redact no names
+        :type names: NameDictionary
+        :param checkpoint: file in which to keep a checkpoint for scrubbing
+            an append-only infile incrementally; see anonymize_incrementally()
+        :type checkpoint: String
+        :param in_compression: compression of infile: 'gzip', 'bz2', 'xz',
+            'zstd' or 'none'; default is to go by the file name extension
+        :type in_compression: String
+        :param out_compression: compression of outfile, like in_compression
+        :type out_compression: String
+        :param io_threads: whether to (de)compress in separate threads,
+            overlapping with scrubbing
+        :type io_threads: bool
+        :param io_buffer_size: bytes read or written at a time
+        :type io_buffer_size: int
+        :param pseudonymizer: replaces detector hits by stable tokens;
+            default is to replace them by <xxxRedac>
+        :type pseudonymizer: Pseudonymizer
+        :param line_buffered: whether to write out each row as soon as it
+            is scrubbed, for interactive use. By default, output is written
+            in chunks of about io_buffer_size bytes
+        :type line_buffered: bool
         '''
         self.infile_name = infile
         self.outfile_name = outfile
+        self.engine = get_engine()
+
+        # Number of processes that scrub in parallel. With
+        # one worker everything happens in this process:
+        if workers < 1:
+            raise ValueError("Number of workers must be at least 1, but was %s" % workers)
+        if shard_size < 1:
+            raise ValueError("Shard size must be at least 1, but was %s" % shard_size)
+        self.workers = workers
+        self.shard_size = shard_size
+
+        # Detector name --> number of fields on which the
+        # detector was skipped, because it could not match:
+        self.skipped_detectors = collections.Counter()
+
+        # Profile of the run, or None if not collecting:
+        self.stats = RunStats(num_slowest) if collect_stats else None
+
+        self.names = names
+
+        self.pseudonymizer = pseudonymizer
+
+        self.in_compression = compression_for(infile, in_compression)
+        self.out_compression = compression_for(outfile, out_compression)
+        self.io_threads = io_threads
+        if io_buffer_size < 1:
+            raise ValueError("I/O buffer size must be at least 1, but was %s" % io_buffer_size)
+        self.io_buffer_size = io_buffer_size
+        self.line_buffered = line_buffered
+
+        if checkpoint is not None and (infile is None or outfile is None):
+            raise ValueError("Incremental scrubbing needs named input and output files")
+        if checkpoint is not None and (self.in_compression is not None or self.out_compression is not None):
+            raise ValueError("Incremental scrubbing does not work on compressed files")
+        self.checkpoint_file = checkpoint
 
     
     def anonymize(self):
@@ -41,28 +611,296 @@ class TextScrubber(object):
         doing the actual work. Instead, unittests call individual methods.
         '''
 
+        if self.checkpoint_file is not None:
+            self.anonymize_incrementally()
+            return
+        infile = outfile = None
         try:
-            if self.infile_name is None:
-                infile = sys.stdin
-            else:
-                infile =  open(self.infile_name, 'r')
+            infile = self.open_input()
+            outfile = self.open_output()
                 
-            if self.outfile_name is None:
-                outfile = sys.stdout
+            if self.workers > 1:
+                if self.infile_name is None or self.in_compression is not None:
+                    # Can't seek in STDIN or compressed files; hand out batches of lines instead:
+                    tasks = iter(lambda: list(itertools.islice(infile, self.STDIN_BATCH_LINES)), [])
+                    func = _scrub_lines
+                else:
+                    tasks = ((self.infile_name, start, end) 
+                             for start, end in shard_boundaries(self.infile_name, self.shard_size))
+                    func = _scrub_shard
+                for scrubbed in imap_ordered(self, func, tasks, self.workers):
+                    outfile.write(scrubbed)
+                    if self.line_buffered:
+                        outfile.flush()
+            elif self.line_buffered:
+                # Interactive use: every row goes out as soon as it is scrubbed:
+                for row in infile:
+                    outfile.write(self.anonymize_text(row.rstrip()) + '\n')
+                    outfile.flush()
             else:
-                outfile = open(self.outfile_name, 'w')
-                
-            for row in infile:
-                row = self.anonymize_text(row.rstrip())
-                outfile.write(row + '\n')
+                # Read, scrub, and write about io_buffer_size bytes at a time,
+                # with one write() call each. Writing row by row costs much
+                # more, especially to a pipe:
+                for lines in iter(lambda: infile.readlines(self.io_buffer_size), []):
+                    outfile.write(self.scrub_lines(lines))
         finally:
-            if self.infile_name is not None:
-                infile.close()
-            if self.outfile_name is not None:
-                outfile.close()
+            close_text(infile)
+            close_text(outfile)
+
+    def open_input(self, newline=None):
+        '''
+        Open the input file, or STDIN, for reading text,
+        decompressing as needed. Close with close_text().
+
+        :param newline: as for open()
+        :type newline: String
+        :rtype: text file
+        '''
+        return open_text(self.infile_name, 'r', self.in_compression, newline, self.io_threads, self.io_buffer_size)
+
+    def open_output(self):
+        '''
+        Open the output file, or STDOUT, for writing text,
+        compressing as needed. Close with close_text().
+
+        :rtype: text file
+        '''
+        return open_text(self.outfile_name, 'w', self.out_compression, None, self.io_threads, self.io_buffer_size)
+
+    def anonymize_incrementally(self):
+        '''
+        Scrub only the part of the input file appended since the
+        checkpoint in self.checkpoint_file, and append the result to
+        the output file. The checkpoint moves forward after each shard,
+        so a run that crashes resumes after the last shard it wrote.
+        A final line without newline is left for the next run, as
+        it may still be being appended.
+        '''
+        checkpoint = Checkpoint.load(self.checkpoint_file)
+        outfile = checkpoint.open_output(self.infile_name, self.outfile_name)
+        try:
+            tasks = [(self.infile_name, start, end) 
+                     for start, end in shard_boundaries(self.infile_name, self.shard_size, 
+                                                        checkpoint.input_offset, complete_size(self.infile_name))]
+            if self.workers > 1:
+                results = imap_ordered(self, _scrub_shard, tasks, self.workers)
             else:
-                outfile.flush()
-                
+                results = (_scrub_shard(self, task) for task in tasks)
+            rows = checkpoint.rows
+            for scrubbed, (_file_name, _start, end) in zip(results, tasks):
+                outfile.write(scrubbed)
+                rows += scrubbed.count('\n')
+                checkpoint.save(self.infile_name, end, rows, outfile)
+        finally:
+            outfile.close()
+
+    def take_counts(self):
+        '''
+        Return the run statistics counted so far, and start counting
+        from zero. Worker processes use this to send their counts to
+        the main process, which adds them up with add_counts().
+
+        :rtype: {String : object}
+        '''
+        counts = {'skipped_detectors' : self.skipped_detectors, 'stats' : self.stats}
+        self.skipped_detectors = collections.Counter()
+        if self.stats is not None:
+            self.stats = RunStats(self.stats.num_slowest)
+        if self.pseudonymizer is not None:
+            counts['pseudonyms'] = self.pseudonymizer.take_counts()
+        return counts
+
+    def add_counts(self, counts):
+        '''
+        Add run statistics obtained from take_counts() to our own.
+        '''
+        self.skipped_detectors.update(counts['skipped_detectors'])
+        if self.stats is not None:
+            self.stats.merge(counts['stats'])
+        if self.pseudonymizer is not None:
+            self.pseudonymizer.add_counts(counts['pseudonyms'])
+
+    def report(self):
+        '''
+        Return a human readable summary of the run statistics.
+
+        :rtype: String
+        '''
+        skipped = ', '.join('%s: %s' % (name, self.skipped_detectors[name]) for name in DETECTOR_NAMES)
+        report = "Fields on which a detector was skipped: %s" % skipped
+        if self.stats is not None:
+            report += '\n' + self.stats.report()
+        if self.pseudonymizer is not None:
+            report += '\n' + self.pseudonymizer.report()
+        return report
+
+    def scrub_lines(self, lines):
+        '''
+        Scrub lines the same way anonymize() does, and return
+        the result as a single string.
+
+        :param lines: lines of text
+        :type lines: iterable of String
+        :returns: scrubbed lines, each terminated by a newline
+        :rtype: String
+        '''
+        scrubbed = [self.anonymize_text(line.rstrip()) for line in lines]
+        # For the newline after the last line:
+        scrubbed.append('')
+        return '\n'.join(scrubbed)
+
+    def scrub_batch(self, records):
+        '''
+        Scrub a batch of records, as handed out by stream().
+
+        :param records: text records
+        :type records: [String]
+        :returns: scrubbed records
+        :rtype: [String]
+        '''
+        return [self.anonymize_text(record) for record in records]
+
+    def scrub_many(self, texts, engine=None):
+        '''
+        Scrub a whole batch of strings held in memory, without going
+        through files. Values that are not strings, such as None or NaN
+        in a pandas column, are passed through unchanged.
+
+        NumPy arrays come back as object arrays of the same shape, and
+        pandas Series as Series with the same index and name. All other
+        inputs come back as lists. NumPy and pandas are optional; they
+        are only looked at if the caller has already imported them.
+
+        :param texts: strings to scrub
+        :type texts: iterable of String, numpy.ndarray, or pandas.Series
+        :param engine: engine with the detectors to run; default is all detectors
+        :type engine: RedactionEngine
+        :returns: scrubbed strings
+        :rtype: [String], numpy.ndarray, or pandas.Series
+        '''
+        anonymize_text = self.anonymize_text
+        if engine is None:
+            engine = self.engine
+
+        numpy = sys.modules.get('numpy')
+        pandas = sys.modules.get('pandas')
+        if pandas is not None and isinstance(texts, pandas.Series):
+            values = texts.tolist()
+        elif numpy is not None and isinstance(texts, numpy.ndarray):
+            values = texts.ravel().tolist()
+        else:
+            values = texts
+
+        scrubbed = [anonymize_text(text, engine) if isinstance(text, str) else text for text in values]
+
+        if pandas is not None and isinstance(texts, pandas.Series):
+            return pandas.Series(scrubbed, index=texts.index, name=texts.name, dtype=object)
+        if numpy is not None and isinstance(texts, numpy.ndarray):
+            result = numpy.empty(len(scrubbed), dtype=object)
+            result[:] = scrubbed
+            return result.reshape(texts.shape)
+        return scrubbed
+
+    def scrub_columns(self, data, columns=None):
+        '''
+        Scrub columns of tabular data held in memory. Columns that are
+        not scrubbed are passed through as they are, without copying.
+
+        :param data: column name --> column values
+        :type data: {String : sequence of String} or pandas.DataFrame
+        :param columns: names of the columns to scrub, or a dict that
+            maps names of columns to scrub to the detectors to run on
+            them; default is all columns with all detectors
+        :type columns: [String] or {String : (String)}
+        :returns: new dict or DataFrame with the scrubbed columns
+        :rtype: {String : [String]} or pandas.DataFrame
+        :raises KeyError: if a column is not in data
+        '''
+        if columns is None:
+            columns = list(data.keys())
+        if isinstance(columns, dict):
+            engines = {col : get_engine(detectors) for col, detectors in columns.items()}
+        else:
+            engines = {col : self.engine for col in columns}
+
+        pandas = sys.modules.get('pandas')
+        if pandas is not None and isinstance(data, pandas.DataFrame):
+            result = data.copy(deep=False)
+        else:
+            result = dict(data)
+        for col, engine in engines.items():
+            result[col] = self.scrub_many(data[col], engine)
+        return result
+
+    async def stream(self, records, 
+                     batch_size=STREAM_BATCH_SIZE, 
+                     concurrency=STREAM_CONCURRENCY,
+                     batch_timeout=STREAM_BATCH_TIMEOUT):
+        '''
+        Asynchronous generator that scrubs records as they arrive, for
+        use inside asyncio services:
+
+            async for clean in scrubber.stream(records):
+                ...
+
+        Records are collected into batches, which are scrubbed in an
+        executor so that the event loop stays free: a pool of
+        self.workers processes if workers > 1, else a single thread.
+        Scrubbed records come out in input order.
+
+        At most concurrency batches are in flight, and at most batch_size
+        records wait to be batched. Beyond that, records are not pulled
+        from the input until the consumer catches up.
+
+        :param records: text records (for a CSVScrubber: rows)
+        :type records: async iterable or iterable
+        :param batch_size: maximum number of records per batch
+        :type batch_size: int
+        :param concurrency: maximum number of batches in flight
+        :type concurrency: int
+        :param batch_timeout: seconds to wait for more records before
+            scrubbing a partial batch
+        :type batch_timeout: float
+        '''
+        if batch_size < 1 or concurrency < 1:
+            raise ValueError("Batch size and concurrency must be at least 1, but were %s and %s" % 
+                             (batch_size, concurrency))
+        loop = asyncio.get_running_loop()
+        if self.workers > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self,))
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        queue = asyncio.Queue(maxsize=batch_size)
+        producer = asyncio.ensure_future(_fill_queue(records, queue))
+        pending = collections.deque()
+        try:
+            end_of_input = False
+            while not end_of_input or pending:
+                # Start new batches while there is room, and the
+                # oldest batch in flight isn't done yet:
+                while not end_of_input and len(pending) < concurrency and not (pending and pending[0].done()):
+                    # With nothing in flight, wait for input as long as it takes:
+                    batch, end_of_input = await _next_batch(queue, 
+                                                            batch_size, 
+                                                            batch_timeout, 
+                                                            wait_for_first=not pending)
+                    if not batch:
+                        break
+                    if self.workers > 1:
+                        pending.append(loop.run_in_executor(executor, _run_in_worker, _scrub_batch, batch))
+                    else:
+                        pending.append(loop.run_in_executor(executor, self.scrub_batch, batch))
+                if pending:
+                    result = await pending.popleft()
+                    if self.workers > 1:
+                        result, counts = result
+                        self.add_counts(counts)
+                    for record in result:
+                        yield record
+        finally:
+            producer.cancel()
+            executor.shutdown(wait=False)
+
 
     def prune_numbers(self, text):
         '''
@@ -74,12 +912,7 @@ class TextScrubber(object):
         :returns: text with all phone number-like substrings replaced by <phoneRedac>
         :rtype: String
         '''
-        #re from stackoverflow. seems to do an awesome job at capturing all phone nos :)
-        s = '((?:(?:\+?1\s*(?:[.-]\s*)?)?(?:\(\s*([2-9]1[02-9]|[2-9][02-8]1|[2-9][02-8][02-9])\s*\)|([2-9]1[02-9]|[2-9][02-8]1|[2-9][02-8][02-9]))\s*(?:[.-]\s*)?)?([2-9]1[02-9]|[2-9][02-9]1|[2-9][02-9]{2})\s*(?:[.-]\s*)?([0-9]{4})(?:\s*(?:#|x\.?|ext\.?|extension)\s*(\d+))?)'
-        match = re.findall(s, text)
-        for phoneMatchHit in match:
-            text = text.replace(phoneMatchHit[0],"<phoneRedac>")
-        return text
+        return get_engine(('phone',)).redact(text)
 
     def prune_zipcode(self, text):
         '''
@@ -91,11 +924,7 @@ class TextScrubber(object):
         :returns: text with all zipcode substrings replaced by <zipRedac>
         :rtype: String
         '''
-        s = '\d{5}(?:[-\s]\d{4})?'
-        match = re.findall(s, text)
-        for zipcodeMatchHit in match:
-            text = text.replace(zipcodeMatchHit,"<zipRedac>")
-        return text
+        return get_engine(('zip',)).redact(text)
 
     def prune_emails(self, text):
         '''
@@ -107,45 +936,34 @@ class TextScrubber(object):
         :returns: text with all email substrings replaced by <emailRedac>
         :rtype: String
         '''
-
-        # Pattern for email id - strings of alphabets/numbers/dots/hyphens followed
-        # by an @ or at followed by combinations of dot/. followed by the edu/com
-        # also, allow for spaces
-        emailPattern = '(.*)\s+([a-zA-Z0-9\(\.\-]+)[@]([a-zA-Z0-9\.]+)(.)(edu|com)\\s*(.*)'
-        #emailPattern='(.*)\\s+([a-zA-Z0-9\\.]+)\\s*(\\(f.*b.*)?(@)\\s*([a-zA-Z0-9\\.\\s;]+)\\s*(\\.)\\s*(edu|com)\\s+(.*)'
-        compiledEmailPattern = re.compile(emailPattern);
-
-        if compiledEmailPattern.match(text) is not None:
-            #print 'BODY before EMAIL STRIPING %posterNamePart \n'%(body);
-            match = re.findall(emailPattern, text)
-            new_text = ""
-            for emailMatchHit in match:
-                new_text += emailMatchHit[0] + " <emailRedac> " + emailMatchHit[-1] 
-                #print 'NEW BODY AFTER EMAIL STRIPING %posterNamePart \n'%(new_body);
-            return new_text
-
-        return text
+        return get_engine(('email',)).redact(text)
 
     def trimnames(self, text):
         '''
-        Removes all person names from the given string. We currently return the text 
-        unchanged, because we found that too many names match regular English words.
+        Removes all person names from the given string. Guessing at names
+        removed too much, because too many names match regular English words.
+        So only names from a curated list (self.names) are removed. Without
+        such a list, the text is returned unchanged.
         :param text: text field
         :type text: String
         :returns: text with all name substrings replaced by <nameRedac>
         :rtype: String
         '''
-        return text
+        if self.names is None:
+            return text
+        return self.names.redact(text)
 
     def trimCrLf(self, text):
         '''
         Replace every CR or LF (\n or \r) in a
         row with a space:
         '''
-        text = re.sub(TextScrubber.CR_LF_PATTERN, ' ', text)
+        # Most cells have no line breaks; don't run the regex on those:
+        if '\n' in text or '\r' in text:
+            text = TextScrubber.CR_LF_PATTERN.sub(' ', text)
         return text
 
-    def anonymize_text(self, text):
+    def anonymize_text(self, text, engine=None):
         '''
         Anonymize text. The following is done:
             - Anything that looks like a phone number is replaced by <phoneRedac>
@@ -153,21 +971,183 @@ class TextScrubber(object):
             - Occurrence of email addresses are replaced by <emailRedac>
         :param text: text field
         :type text: String
+        :param engine: engine with the detectors to run; default is all detectors
+        :type engine: RedactionEngine
         '''
 
-        text = self.prune_numbers(text)
-        text = self.prune_zipcode(text)
-        text = self.prune_emails(text)
+        if engine is None:
+            engine = self.engine
+
+        # Don't run detectors that cannot match, such
+        # as the phone detector on text without digits:
+        engine, skipped = engine.gate(text)
+        for name in skipped:
+            self.skipped_detectors[name] += 1
+
+        # The remaining detectors run in a single pass over the text:
+        replace = self.pseudonymizer.replace if self.pseudonymizer is not None else None
+        if self.stats is None:
+            text = engine.redact(text, replace)
+        else:
+            if self.ROW_PER_FIELD:
+                self.stats.row_num += 1
+            text = self.stats.profile(text, engine, replace)
 
-        # Trim names from post. This method currently does nothing, b/c
-        # some of the names people give are very common English words. 
-        # (Implementation removes too much)
+        # Trim names from post. Only names from a curated list are
+        # removed, b/c some of the names people give are very common
+        # English words. (Guessing at names removes too much)
         text = self.trimnames(text)
 
         # text = self.trimCrLf(text)
 
         return text
 
+#--------------------------- Sharding and Worker Processes ---------------------
+
+def shard_boundaries(file_name, shard_size, start=0, end=None):
+    '''
+    Split a file, or the part of it from start to end, into byte ranges
+    of roughly shard_size bytes. Each range except the last ends right
+    after a newline, so no line is split between two shards.
+
+    :param file_name: file to split
+    :type file_name: String
+    :param shard_size: approximate number of bytes per shard
+    :type shard_size: int
+    :param start: offset of the first byte to include; must be
+        the start of a line
+    :type start: int
+    :param end: offset after the last byte to include; default is
+        the end of the file
+    :type end: int
+    :returns: (start, end) byte offsets, end exclusive
+    :rtype: [(int, int)]
+    '''
+    boundaries = []
+    file_size = os.path.getsize(file_name) if end is None else end
+    with open(file_name, 'rb') as fd:
+        while start < file_size:
+            fd.seek(min(start + shard_size, file_size) - 1)
+            # Move to just after the next newline (or to EOF):
+            fd.readline()
+            shard_end = min(fd.tell(), file_size)
+            boundaries.append((start, shard_end))
+            start = shard_end
+    return boundaries
+
+def imap_ordered(scrubber, func, tasks, workers):
+    '''
+    Generator that runs func(scrubber, task) for each task in a pool
+    of worker processes, and yields the results in task order.
+
+    At most two tasks per worker are in flight at any time. Tasks are
+    only pulled from the tasks iterable as results are consumed, so
+    memory stays bounded no matter how many tasks there are.
+
+    Each result comes back with the worker's run statistics, which
+    are added to those of scrubber.
+
+    :param scrubber: scrubber the workers use; must be picklable
+    :type scrubber: TextScrubber
+    :param func: module-level function taking a scrubber and a task
+    :type func: function
+    :param tasks: units of work
+    :type tasks: iterable
+    :param workers: number of worker processes
+    :type workers: int
+    '''
+    max_pending = 2 * workers
+    pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(scrubber,))
+    try:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(pool.apply_async(_run_in_worker, (func, task)))
+            if len(pending) >= max_pending:
+                yield _collect(scrubber, pending.popleft())
+        while pending:
+            yield _collect(scrubber, pending.popleft())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+# The scrubber each worker process uses; set by _init_worker():
+_worker_scrubber = None
+
+def _init_worker(scrubber):
+    global _worker_scrubber
+    _worker_scrubber = scrubber
+
+def _run_in_worker(func, task):
+    return func(_worker_scrubber, task), _worker_scrubber.take_counts()
+
+def _collect(scrubber, async_result):
+    result, counts = async_result.get()
+    scrubber.add_counts(counts)
+    return result
+
+def _scrub_lines(scrubber, lines):
+    return scrubber.scrub_lines(lines)
+
+def _scrub_batch(scrubber, batch):
+    return scrubber.scrub_batch(batch)
+
+class _EndOfInput(object):
+    '''
+    Queue entry that marks the end of stream() input, and carries the
+    exception raised by the input iterator, if any.
+    '''
+    def __init__(self, error=None):
+        self.error = error
+
+async def _fill_queue(records, queue):
+    try:
+        if hasattr(records, '__aiter__'):
+            async for record in records:
+                await queue.put(record)
+        else:
+            for record in records:
+                await queue.put(record)
+    except Exception as e:
+        await queue.put(_EndOfInput(e))
+    else:
+        await queue.put(_EndOfInput())
+
+async def _next_batch(queue, batch_size, timeout, wait_for_first):
+    '''
+    Take up to batch_size records from queue. Waits at most timeout
+    seconds for each record, except for the first one if wait_for_first
+    is True.
+
+    :returns: the records, and whether the end of input was reached
+    :rtype: ([object], bool)
+    '''
+    batch = []
+    while len(batch) < batch_size:
+        try:
+            if not batch and wait_for_first:
+                record = await queue.get()
+            else:
+                record = await asyncio.wait_for(queue.get(), timeout)
+        except asyncio.TimeoutError:
+            break
+        if isinstance(record, _EndOfInput):
+            if record.error is not None:
+                raise record.error
+            return batch, True
+        batch.append(record)
+    return batch, False
+
+def _scrub_shard(scrubber, shard):
+    file_name, start, end = shard
+    with open(file_name, 'rb') as fd:
+        fd.seek(start)
+        data = fd.read(end - start)
+    # Decode the same way open(file_name, 'r') would,
+    # including universal newlines:
+    lines = io.TextIOWrapper(io.BytesIO(data), encoding=locale.getpreferredencoding(False))
+    return scrubber.scrub_lines(lines)
+
 if __name__ == '__main__':
     
     parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]), formatter_class=argparse.RawTextHelpFormatter)
@@ -182,9 +1162,106 @@ if __name__ == '__main__':
                         help="File to which scrubbed content is to be written; default is STDOUT",
                         default=None
                         )
+    parser.add_argument('-w', '--workers',
+                        action='store',
+                        type=int,
+                        help="Number of processes that scrub in parallel; default: 1",
+                        default=1
+                        )
+    parser.add_argument('-s', '--shardsize',
+                        action='store',
+                        type=int,
+                        help="Approximate number of input bytes each worker scrubs at a time; default: %s" % TextScrubber.DEFAULT_SHARD_SIZE,
+                        default=TextScrubber.DEFAULT_SHARD_SIZE
+                        )
+    parser.add_argument('-n', '--names',
+                        action='store',
+                        help="File with names to redact, one per line. The lookup tables built from\n"
+                             "it are kept in <file>.trie, and rebuilt when the file changes.",
+                        default=None
+                        )
+    parser.add_argument('--stats',
+                        action='store_true',
+                        help="Profile the detectors, and print run statistics to STDERR when done",
+                        default=False
+                        )
+    parser.add_argument('--slowest',
+                        action='store',
+                        type=int,
+                        help="Number of slowest fields to list with --stats; default: 10",
+                        default=10
+                        )
+    parser.add_argument('-k', '--checkpoint',
+                        action='store',
+                        help="Checkpoint file for scrubbing an append-only infile incrementally:\n"
+                             "only text appended since the last run is scrubbed, and appended\n"
+                             "to outfile. A crashed run resumes from its last checkpoint.",
+                        default=None
+                        )
+    parser.add_argument('--incompression',
+                        action='store',
+                        choices=COMPRESSIONS + ('none',),
+                        help="Compression of infile; default: by extension (.gz, .bz2, .xz, .zst)",
+                        default=None
+                        )
+    parser.add_argument('--outcompression',
+                        action='store',
+                        choices=COMPRESSIONS + ('none',),
+                        help="Compression of outfile; default: by extension (.gz, .bz2, .xz, .zst)",
+                        default=None
+                        )
+    parser.add_argument('--iothreads',
+                        action='store_true',
+                        help="Decompress input and compress output in separate threads",
+                        default=False
+                        )
+    parser.add_argument('--iobuffersize',
+                        action='store',
+                        type=int,
+                        help="Bytes read or written at a time; default: %s" % DEFAULT_BUFFER_SIZE,
+                        default=DEFAULT_BUFFER_SIZE
+                        )
+    parser.add_argument('--linebuffered',
+                        action='store_true',
+                        help="Write out each line as soon as it is scrubbed, for interactive use",
+                        default=False
+                        )
+    parser.add_argument('--pseudokey',
+                        action='store',
+                        help="File holding a secret key. With it, phone numbers, zipcodes and emails\n"
+                             "are replaced by stable tokens such as <email:3fa9c1d2e4b5>, computed\n"
+                             "with a keyed hash, rather than by <xxxRedac>",
+                        default=None
+                        )
+    parser.add_argument('--tokenlength',
+                        action='store',
+                        type=int,
+                        help="Number of hex digits in tokens; default: %s" % Pseudonymizer.DEFAULT_TOKEN_LENGTH,
+                        default=Pseudonymizer.DEFAULT_TOKEN_LENGTH
+                        )
     
     args = parser.parse_args();
 
-    scrubber = TextScrubber(args.infile, args.outfile)
-    scrubber.anonymize()    
+    names = NameDictionary.load_or_build(args.names) if args.names is not None else None
+    pseudonymizer = None
+    if args.pseudokey is not None:
+        with open(args.pseudokey, 'rb') as fd:
+            pseudonymizer = Pseudonymizer(fd.read().strip(), token_length=args.tokenlength)
+    scrubber = TextScrubber(args.infile, 
+                            args.outfile, 
+                            workers=args.workers, 
+                            shard_size=args.shardsize,
+                            collect_stats=args.stats,
+                            num_slowest=args.slowest,
+                            names=names,
+                            checkpoint=args.checkpoint,
+                            in_compression=args.incompression,
+                            out_compression=args.outcompression,
+                            io_threads=args.iothreads,
+                            io_buffer_size=args.iobuffersize,
+                            pseudonymizer=pseudonymizer,
+                            line_buffered=args.linebuffered)
+    scrubber.anonymize()
+    if args.stats:
+        sys.stderr.write(scrubber.report() + '\n')    
         
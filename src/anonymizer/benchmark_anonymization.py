@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# Copyright (c) 2014, Stanford University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+Benchmark suite for the scrubbers. Generates synthetic text and CSV
+corpora with a controlled density of phone numbers, zipcodes, and
+email addresses, plus adversarial rows. Measures throughput, time per
+detector, and peak memory, and writes the results as JSON, so that
+runs of different versions can be compared. Not part of the
+unittests; run from the command line:
+
+    python benchmark_anonymization.py --rows 100000 --outfile results.json
+
+'''
+
+import argparse
+import concurrent.futures
+import csv
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+from tempfile import NamedTemporaryFile
+import time
+
+from anonymize_csv import CSVScrubber
+from anonymize_txt import TextScrubber, DETECTOR_NAMES, get_engine
+
+
+FILLER_WORDS = ('the', 'course', 'thanks', 'for', 'quick', 'reply', 'homework', 'week',
+                'lecture', 'video', 'question', 'about', 'great', 'problem', 'set', 'I',
+                'think', 'answer', 'is', 'wrong', 'please', 'help', 'with', 'quiz')
+
+PII_SAMPLES = {'phone' : ('650-327-7398', '(415) 555-2671', '+1 212.555.0199', '408 555 1234 ext 12'),
+               'zip'   : ('94025', '94305-2004', '10027', '02139'),
+               'email' : ('foo@gmail.com', 'john.doe@stanford.edu', 'a-b.c@mail.example.com', 'x1@cs.stanford.edu'),
+               }
+
+# Rows that are expensive for badly written regexes:
+ADVERSARIAL_FIELDS = (' ' * 2000 + 'a@b.co',
+                      ' a@' * 500,
+                      '@' * 2000,
+                      ' ' + 'a.' * 500 + '@' + 'b.' * 500,
+                      '1' * 2000,
+                      '2 ' * 1000,
+                      )
+
+def make_field(rand, density, adversarial):
+    '''
+    Return one field of forum-like text. Each detector's sample PII
+    shows up in the field with probability density, and the whole
+    field is an adversarial one with probability adversarial.
+
+    :param rand: random generator
+    :type rand: random.Random
+    :param density: probability of each kind of PII in the field
+    :type density: float
+    :param adversarial: probability of an adversarial field
+    :type adversarial: float
+    :rtype: String
+    '''
+    if rand.random() < adversarial:
+        return rand.choice(ADVERSARIAL_FIELDS)
+    words = [rand.choice(FILLER_WORDS) for _ in range(rand.randint(3, 15))]
+    for detector in DETECTOR_NAMES:
+        if rand.random() < density:
+            words.insert(rand.randint(0, len(words)), rand.choice(PII_SAMPLES[detector]))
+    return ' '.join(words)
+
+def make_text_corpus(file_name, num_rows, density=0.1, adversarial=0.001, seed=0):
+    '''
+    Write a text file with num_rows lines; see make_field().
+
+    :param file_name: file to write
+    :type file_name: String
+    :param num_rows: number of lines
+    :type num_rows: int
+    :param density: probability of each kind of PII in a line
+    :type density: float
+    :param adversarial: probability of an adversarial line
+    :type adversarial: float
+    :param seed: seed for the random generator
+    :type seed: int
+    '''
+    rand = random.Random(seed)
+    with open(file_name, 'w') as fd:
+        for _row_num in range(num_rows):
+            fd.write(make_field(rand, density, adversarial) + '\n')
+
+def make_csv_corpus(file_name, num_rows, num_cols=4, density=0.1, adversarial=0.001, seed=0):
+    '''
+    Write a CSV file with num_rows rows. The first column holds
+    the row number, the others fields as made by make_field().
+    Some fields are quoted, and span several lines.
+
+    :param file_name: file to write
+    :type file_name: String
+    :param num_rows: number of CSV rows
+    :type num_rows: int
+    :param num_cols: number of columns
+    :type num_cols: int
+    :param density: probability of each kind of PII in a field
+    :type density: float
+    :param adversarial: probability of an adversarial field
+    :type adversarial: float
+    :param seed: seed for the random generator
+    :type seed: int
+    '''
+    rand = random.Random(seed)
+    with open(file_name, 'w') as fd:
+        for row_num in range(num_rows):
+            fields = [str(row_num)]
+            for _col in range(num_cols - 1):
+                field = make_field(rand, density, adversarial)
+                if rand.random() < 0.05:
+                    field = '"%s\n%s"' % (field, make_field(rand, density, adversarial))
+                elif ',' in field:
+                    field = '"%s"' % field
+                fields.append(field)
+            fd.write(','.join(fields) + '\n')
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    '''
+    Peak resident set size so far, in bytes.
+
+    :param who: resource.RUSAGE_SELF for this process, or
+        resource.RUSAGE_CHILDREN for the largest child process
+        waited for
+    :type who: int
+    '''
+    max_rss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes:
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+def count_rows(file_name):
+    with open(file_name, 'r') as fd:
+        return sum(1 for _line in fd)
+
+def count_csv_rows(file_name):
+    with open(file_name, 'r', newline='') as fd:
+        return sum(1 for _row in csv.reader(fd))
+
+def time_scrubber(scrubber):
+    '''
+    Run a scrubber, and return the elapsed wall clock seconds.
+    '''
+    start_time = time.time()
+    scrubber.anonymize()
+    return time.time() - start_time
+
+def bench_txt_anonymize(corpus, **kwargs):
+    '''
+    TextScrubber.anonymize() on a text corpus; kwargs go to the scrubber.
+    '''
+    with NamedTemporaryFile(suffix='.txt') as outfile_fd:
+        seconds = time_scrubber(TextScrubber(corpus, outfile_fd.name, **kwargs))
+    return {'seconds' : seconds, 'rows' : count_rows(corpus), 'bytes' : os.path.getsize(corpus)}
+
+def bench_csv_anonymize(corpus, **kwargs):
+    '''
+    CSVScrubber.anonymize() on a CSV corpus; kwargs go to the scrubber.
+    '''
+    with NamedTemporaryFile(suffix='.csv') as outfile_fd:
+        seconds = time_scrubber(CSVScrubber(corpus, outfile_fd.name, **kwargs))
+    return {'seconds' : seconds, 'rows' : count_csv_rows(corpus), 'bytes' : os.path.getsize(corpus)}
+
+def bench_pipe_anonymize(corpus, script, line_buffered=False):
+    '''
+    Run a scrubber script on a corpus, with output to a pipe that this
+    process drains. Includes the startup time of the script. The peak
+    RSS is that of the script, the only child of the benchmark process.
+    '''
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), script), '-i', corpus]
+    if line_buffered:
+        command.append('--linebuffered')
+    start_time = time.time()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    for _chunk in iter(lambda: process.stdout.read(1024 * 1024), b''):
+        pass
+    process.stdout.close()
+    if process.wait() != 0:
+        raise RuntimeError("%s failed with exit code %s" % (script, process.returncode))
+    seconds = time.time() - start_time
+    count = count_csv_rows if script == 'anonymize_csv.py' else count_rows
+    return {'seconds' : seconds,
+            'rows' : count(corpus),
+            'bytes' : os.path.getsize(corpus),
+            'peak_rss_bytes' : peak_rss(resource.RUSAGE_CHILDREN)}
+
+def bench_anonymize_text(corpus):
+    '''
+    TextScrubber.anonymize_text() on every line of a text corpus, without file I/O.
+    '''
+    with open(corpus, 'r') as fd:
+        lines = [line.rstrip() for line in fd]
+    anonymizer = TextScrubber()
+    start_time = time.time()
+    for line in lines:
+        anonymizer.anonymize_text(line)
+    seconds = time.time() - start_time
+    return {'seconds' : seconds, 'rows' : len(lines), 'bytes' : os.path.getsize(corpus)}
+
+def bench_detectors(corpus):
+    '''
+    Time each detector by itself on every line of a text corpus.
+    '''
+    with open(corpus, 'r') as fd:
+        lines = [line.rstrip() for line in fd]
+    detector_seconds = {}
+    for detector in DETECTOR_NAMES:
+        engine = get_engine((detector,))
+        start_time = time.time()
+        for line in lines:
+            engine.redact(line)
+        detector_seconds[detector] = time.time() - start_time
+    return {'seconds' : sum(detector_seconds.values()),
+            'rows' : len(lines),
+            'bytes' : os.path.getsize(corpus),
+            'detector_seconds' : detector_seconds}
+
+# Benchmark name --> (function, corpus kind, keyword args):
+BENCHMARKS = (('txt_anonymize',               bench_txt_anonymize,  'txt', {}),
+              ('txt_anonymize_line_buffered', bench_txt_anonymize,  'txt', {'line_buffered' : True}),
+              ('txt_pipe',                    bench_pipe_anonymize, 'txt', {'script' : 'anonymize_txt.py'}),
+              ('txt_pipe_line_buffered',      bench_pipe_anonymize, 'txt', {'script' : 'anonymize_txt.py', 'line_buffered' : True}),
+              ('csv_anonymize',               bench_csv_anonymize,  'csv', {}),
+              ('csv_anonymize_line_buffered', bench_csv_anonymize,  'csv', {'line_buffered' : True}),
+              ('csv_anonymize_streaming',     bench_csv_anonymize,  'csv', {'streaming' : True}),
+              ('csv_pipe',                    bench_pipe_anonymize, 'csv', {'script' : 'anonymize_csv.py'}),
+              ('csv_pipe_line_buffered',      bench_pipe_anonymize, 'csv', {'script' : 'anonymize_csv.py', 'line_buffered' : True}),
+              ('anonymize_text',              bench_anonymize_text, 'txt', {}),
+              ('detectors',                   bench_detectors,      'txt', {}),
+              )
+
+def _run_benchmark(func, corpus, kwargs):
+    result = func(corpus, **kwargs)
+    # Benchmarks that run a subprocess report the peak RSS of that:
+    result.setdefault('peak_rss_bytes', peak_rss())
+    return result
+
+def run_benchmarks(num_rows, density=0.1, adversarial=0.001, seed=0, names=None):
+    '''
+    Generate corpora, and run the benchmarks. Each benchmark runs in a
+    fresh process, so that its peak RSS is its own.
+
+    :param num_rows: number of lines/rows in each corpus
+    :type num_rows: int
+    :param density: probability of each kind of PII in a field
+    :type density: float
+    :param adversarial: probability of an adversarial field
+    :type adversarial: float
+    :param seed: seed for the random generator
+    :type seed: int
+    :param names: names of benchmarks to run; default is all of BENCHMARKS
+    :type names: [String]
+    :returns: JSON-serializable results
+    :rtype: dict
+    '''
+    results = {}
+    with NamedTemporaryFile(suffix='.txt') as txt_fd, NamedTemporaryFile(suffix='.csv') as csv_fd:
+        make_text_corpus(txt_fd.name, num_rows, density, adversarial, seed)
+        make_csv_corpus(csv_fd.name, num_rows, density=density, adversarial=adversarial, seed=seed)
+        corpora = {'txt' : txt_fd.name, 'csv' : csv_fd.name}
+        for name, func, corpus_kind, kwargs in BENCHMARKS:
+            if names is not None and name not in names:
+                continue
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(_run_benchmark, func, corpora[corpus_kind], kwargs).result()
+            seconds = max(result['seconds'], 1e-9)
+            result['rows_per_sec'] = result['rows'] / seconds
+            result['mb_per_sec'] = result['bytes'] / seconds / (1024 * 1024)
+            results[name] = result
+
+    return {'timestamp' : datetime.datetime.now().isoformat(),
+            'python' : platform.python_version(),
+            'platform' : platform.platform(),
+            'config' : {'rows' : num_rows, 'density' : density, 'adversarial' : adversarial, 'seed' : seed},
+            'results' : results,
+            }
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]), formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('-r', '--rows',
+                        action='store',
+                        type=int,
+                        help="Number of lines/rows in each generated corpus; default: 100000",
+                        default=100000
+                        )
+    parser.add_argument('-d', '--density',
+                        action='store',
+                        type=float,
+                        help="Probability of each kind of PII in a field; default: 0.1",
+                        default=0.1
+                        )
+    parser.add_argument('-a', '--adversarial',
+                        action='store',
+                        type=float,
+                        help="Probability of an adversarial field; default: 0.001",
+                        default=0.001
+                        )
+    parser.add_argument('-s', '--seed',
+                        action='store',
+                        type=int,
+                        help="Seed for the corpus generator; default: 0",
+                        default=0
+                        )
+    parser.add_argument('-b', '--benchmark',
+                        action='store',
+                        nargs='*',
+                        help="Benchmarks to run; default: all of %s" % ', '.join(name for name, _f, _c, _k in BENCHMARKS),
+                        default=None
+                        )
+    parser.add_argument('-o', '--outfile',
+                        action='store',
+                        help="File to which JSON results are written; default is STDOUT",
+                        default=None
+                        )
+
+    args = parser.parse_args();
+
+    results = run_benchmarks(args.rows, args.density, args.adversarial, args.seed, args.benchmark)
+    if args.outfile is None:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.outfile, 'w') as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
@@ -3,12 +3,36 @@ Created on Dec 14, 2017
 
 @author: paepcke
 '''
+import asyncio
+import io
+import json
+import os
+import re
+import stat
 import sys
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryDirectory, gettempdir
+import threading
+import time
 import unittest
 
-from anonymize_csv import CSVScrubber
-from anonymize_txt import TextScrubber
+try:
+    import numpy
+    import pandas
+except ImportError:
+    numpy = pandas = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from anonymize_client import scrub
+from anonymize_csv import CSVScrubber, parse_profile
+from anonymize_io import compression_for, open_binary
+from anonymize_names import NameDictionary
+from anonymize_parquet import ParquetScrubber
+from anonymize_server import ChunkSplitter, ScrubServer
+from anonymize_txt import TextScrubber, LRUCache, Pseudonymizer, get_engine, shard_boundaries
 
 
 TEST_ALL = True
@@ -31,6 +55,7 @@ class TestAnonymization(unittest.TestCase):
         self.tst_outfile_fd = NamedTemporaryFile(prefix='anonymization_tst',
                                                  suffix='.txt',
                                                  dir='/tmp',
+                                                 mode='w+',
                                                  delete=True)
         
     #-----------------------------
@@ -45,7 +70,7 @@ class TestAnonymization(unittest.TestCase):
         truth = iter(self.redacted_lines_txt)
         for redacted_line in self.tst_outfile_fd:
             #print(redacted_line)
-            self.assertEqual(redacted_line.rstrip(), truth.next())
+            self.assertEqual(redacted_line.rstrip(), next(truth))
 
     #-----------------------------
     # testCsvAllColumns
@@ -59,7 +84,7 @@ class TestAnonymization(unittest.TestCase):
         truth = iter(self.redacted_lines_all_columns_csv)
         for redacted_row in self.tst_outfile_fd:
             #print(redacted_row.rstrip())
-            self.assertEqual(redacted_row.rstrip(), truth.next())
+            self.assertEqual(redacted_row.rstrip(), next(truth))
 
     #-----------------------------
     # testCsvAllNotAllColumns
@@ -75,7 +100,7 @@ class TestAnonymization(unittest.TestCase):
         truth = iter(self.redacted_lines_not_column_0_csv)
         for redacted_row in self.tst_outfile_fd:
             #print(redacted_row.rstrip())
-            self.assertEqual(redacted_row.rstrip(), truth.next())
+            self.assertEqual(redacted_row.rstrip(), next(truth))
 
     #-----------------------------
     # test_in_piping 
@@ -97,10 +122,670 @@ class TestAnonymization(unittest.TestCase):
             truth = iter(self.redacted_lines_all_columns_csv)
             for redacted_row in self.tst_outfile_fd:
                 #print(redacted_row.rstrip())
-                self.assertEqual(redacted_row.rstrip(), truth.next())
+                self.assertEqual(redacted_row.rstrip(), next(truth))
         finally:
             sys.stdin = saved_stdin
         
+    #-----------------------------
+    # testSinglePassEngine
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL, "Temporarily disabled")
+    def testSinglePassEngine(self):
+        anonymizer = TextScrubber()
+        for line, truth in zip(self.txt_tst_lines, self.redacted_lines_txt):
+            self.assertEqual(anonymizer.anonymize_text(line).rstrip(), truth)
+            # Same result as running the detectors one after the other:
+            sequential = anonymizer.prune_emails(anonymizer.prune_zipcode(anonymizer.prune_numbers(line)))
+            self.assertEqual(anonymizer.anonymize_text(line), sequential)
+
+        # Phone numbers win over zipcodes that start earlier:
+        self.assertEqual(anonymizer.anonymize_text('call 1234567890'), 'call 1<phoneRedac>90')
+        # ... but without the phone detector, zipcodes are found as they always were:
+        for text in ('2025550123', '123456789', 'call 1234567890', 'zip 94025-1234 or 94305'):
+            baseline = text
+            for hit in re.findall(r'\d{5}(?:[-\s]\d{4})?', text):
+                baseline = baseline.replace(hit, '<zipRedac>')
+            self.assertEqual(anonymizer.prune_zipcode(text), baseline)
+        self.assertEqual(anonymizer.prune_zipcode('2025550123'), '<zipRedac><zipRedac>')
+        self.assertEqual(anonymizer.anonymize_text('2025550123', get_engine(('zip',))), '<zipRedac><zipRedac>')
+        # Engines are shared, and detector order is canonical:
+        self.assertIs(get_engine(('email', 'phone')), get_engine(('phone', 'email')))
+        with self.assertRaises(ValueError):
+            get_engine(('phone', 'ssn'))
+        
+    #-----------------------------
+    # testEmailAllAddresses
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL, "Temporarily disabled")
+    def testEmailAllAddresses(self):
+        anonymizer = TextScrubber()
+        self.assertEqual(anonymizer.prune_emails('mail a@b.com or c.d@stanford.edu today'),
+                         'mail <emailRedac> or <emailRedac> today')
+        self.assertEqual(anonymizer.prune_emails('foo@gmail.com is mine'),
+                         '<emailRedac> is mine')
+        self.assertEqual(anonymizer.prune_emails('no address@here'), 'no address@here')
+
+    #-----------------------------
+    # testEmailAdversarialTiming
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL, "Temporarily disabled")
+    def testEmailAdversarialTiming(self):
+        # Inputs that made the old (.*)-bracketed email pattern
+        # backtrack for minutes. Each must scrub well within budget:
+        size = 100000
+        adversarial = [' ' * size + 'a@b.co',
+                       ' a@' * size,
+                       '@' * size,
+                       ' ' + 'a.' * size + '@' + 'b.' * size,
+                       ' a@b' * size,
+                       'a@' + 'b' * size,
+                       '\t@' * size,
+                       ]
+        anonymizer = TextScrubber()
+        for text in adversarial:
+            start_time = time.time()
+            anonymizer.anonymize_text(text)
+            self.assertLess(time.time() - start_time, 1.0)
+        
+    #-----------------------------
+    # testCsvParallel
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL, "Temporarily disabled")
+    def testCsvParallel(self):
+        with NamedTemporaryFile(prefix='anonymization_tst', suffix='.csv', dir='/tmp', mode='w+') as infile_fd, \
+             NamedTemporaryFile(prefix='anonymization_tst', suffix='.txt', dir='/tmp', mode='w+') as serial_fd:
+            for i in range(50):
+                for line in self.csv_tst_lines:
+                    infile_fd.write('%s,%s\n' % (i, line))
+            infile_fd.flush()
+
+            CSVScrubber(infile_fd.name, serial_fd.name, ignore_cols=[2]).anonymize()
+            anonymizer = CSVScrubber(infile_fd.name, 
+                                     self.tst_outfile_fd.name,
+                                     ignore_cols=[2],
+                                     workers=3,
+                                     batch_size=7)
+            anonymizer.anonymize()
+            self.assertEqual(self.tst_outfile_fd.read(), serial_fd.read())
+
+        with self.assertRaises(ValueError):
+            CSVScrubber(workers=0)
+        
+    #-----------------------------
+    # testTxtSharded
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL, "Temporarily disabled")
+    def testTxtSharded(self):
+        with NamedTemporaryFile(prefix='anonymization_tst', suffix='.txt', dir='/tmp', mode='wb') as infile_fd, \
+             NamedTemporaryFile(prefix='anonymization_tst', suffix='.txt', dir='/tmp', mode='w+') as serial_fd:
+            for i in range(50):
+                for line in self.txt_tst_lines:
+                    infile_fd.write(('%s %s\r\n' % (i, line)).encode('ascii'))
+            infile_fd.write(b'no final newline 94025')
+            infile_fd.flush()
+
+            boundaries = shard_boundaries(infile_fd.name, 100)
+            self.assertEqual(boundaries[0][0], 0)
+            self.assertEqual(boundaries[-1][1], os.path.getsize(infile_fd.name))
+            for (_start, end), (next_start, _next_end) in zip(boundaries, boundaries[1:]):
+                self.assertEqual(end, next_start)
+
+            TextScrubber(infile_fd.name, serial_fd.name).anonymize()
+            anonymizer = TextScrubber(infile_fd.name, 
+                                      self.tst_outfile_fd.name,
+                                      workers=3,
+                                      shard_size=100)
+            anonymizer.anonymize()
+            self.assertEqual(self.tst_outfile_fd.read(), serial_fd.read())
+        
+    #-----------------------------
+    # testCsvStreaming
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL, "Temporarily disabled")
+    def testCsvStreaming(self):
+        with NamedTemporaryFile(prefix='anonymization_tst', suffix='.csv', dir='/tmp', mode='w+') as infile_fd:
+            infile_fd.write('"Call\n650-327-7398",keep,"multi\r\nline"\n')
+            infile_fd.write('Mail foo@gmail.com,"a\nb",plain\n')
+            infile_fd.flush()
+            anonymizer = CSVScrubber(infile_fd.name, 
+                                     self.tst_outfile_fd.name,
+                                     ignore_cols=[1],
+                                     streaming=True)
+            anonymizer.anonymize()
+        # Line breaks survive only in the ignored column:
+        self.assertEqual(self.tst_outfile_fd.read(),
+                         'Call <phoneRedac>,keep,multi  line\n'
+                         'Mail <emailRedac> ,"a\nb",plain\n')
+        
+    #-----------------------------
+    # testCsvColumnProfiles
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL, "Temporarily disabled")
+    def testCsvColumnProfiles(self):
+        # Column 0 only gets zipcodes redacted, and column 2 (its
+        # header is 'last column') only emails:
+        profile = parse_profile(['0=zip', 'last column=email'])
+        self.assertEqual(profile, {0 : ('zip',), 'last column' : ('email',)})
+        anonymizer = CSVScrubber(self.tst_csv_infile, self.tst_outfile_fd.name, profile=profile, streaming=True)
+        anonymizer.anonymize()
+        redacted = [row.rstrip() for row in self.tst_outfile_fd]
+        self.assertEqual(redacted[0], 'First <zipRedac> line,<zipRedac>,last column')
+        self.assertEqual(redacted[2], '650-327-7398,A US phone number is <phoneRedac>,last 650-327-7398 column')
+        self.assertEqual(redacted[5], 'First line,An email address <emailRedac> ,last <emailRedac>')
+
+        with self.assertRaises(ValueError):
+            parse_profile(['0=ssn'])
+        with self.assertRaises(ValueError):
+            CSVScrubber(self.tst_csv_infile, self.tst_outfile_fd.name, profile={'no such column' : ()}).anonymize()
+
+    #-----------------------------
+    # testCsvAutoProfile
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL, "Temporarily disabled")
+    def testCsvAutoProfile(self):
+        anonymizer = CSVScrubber(self.tst_csv_infile, self.tst_outfile_fd.name, auto_profile_rows=3)
+        anonymizer.anonymize()
+        self.assertEqual(anonymizer.column_engines[0].detectors, ('phone', 'zip'))
+        self.assertEqual(anonymizer.column_engines[1].detectors, ('phone', 'zip'))
+        self.assertEqual(anonymizer.column_engines[2].detectors, ('phone',))
+        # Sampled rows are scrubbed like all others:
+        redacted = [row.rstrip() for row in self.tst_outfile_fd]
+        self.assertEqual(redacted[:5], self.redacted_lines_all_columns_csv[:5])
+        
+    #-----------------------------
+    # testCsvCache
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL, "Temporarily disabled")
+    def testCsvCache(self):
+        anonymizer = CSVScrubber(self.tst_csv_infile, self.tst_outfile_fd.name, cache_size=4)
+        anonymizer.anonymize()
+        truth = iter(self.redacted_lines_all_columns_csv)
+        for redacted_row in self.tst_outfile_fd:
+            self.assertEqual(redacted_row.rstrip(), next(truth))
+        # 'First line' and 'last column' repeat, but with only four
+        # slots some repeats are evicted before they come around again:
+        self.assertEqual((anonymizer.cache.hits, anonymizer.cache.misses), (4, 14))
+        self.assertEqual(anonymizer.cache.evictions, 10)
+
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual(cache.take_counts(), (3, 1, 1))
+        self.assertEqual(cache.take_counts(), (0, 0, 0))
+        
+    #-----------------------------
+    # testDetectorGating
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL, "Temporarily disabled")
+    def testDetectorGating(self):
+        engine = get_engine()
+        self.assertEqual(engine.gate('no digits here')[1], ('phone', 'zip', 'email'))
+        self.assertEqual(engine.gate('zip 94025')[0].detectors, ('phone', 'zip'))
+        self.assertIs(engine.gate('94025 or foo@gmail.com')[0], engine)
+
+        # Gates let through non-ASCII digits, which \d in the patterns matches:
+        anonymizer = TextScrubber()
+        for text in ('zip \uff19\uff14\uff10\uff12\uff15 here', 'zip \u0669\u0664\u0660\u0662\u0665 here'):
+            self.assertEqual(engine.gate(text)[0].detectors, ('phone', 'zip'))
+            self.assertEqual(anonymizer.anonymize_text(text), 'zip <zipRedac> here')
+            self.assertEqual(anonymizer.anonymize_text(text), engine.redact(text))
+        self.assertEqual(engine.gate('caf\u00e9 au lait')[1], ('phone', 'zip', 'email'))
+
+        anonymizer = TextScrubber(self.tst_txt_infile, self.tst_outfile_fd.name)
+        anonymizer.anonymize()
+        self.assertEqual([line.rstrip() for line in self.tst_outfile_fd], self.redacted_lines_txt)
+        self.assertEqual(anonymizer.skipped_detectors, {'phone' : 2, 'zip' : 2, 'email' : 6})
+
+        # Worker processes' counts add up to the same totals:
+        anonymizer = CSVScrubber(self.tst_csv_infile, self.tst_outfile_fd.name, workers=2, batch_size=2)
+        anonymizer.anonymize()
+        self.assertEqual(anonymizer.skipped_detectors, {'phone' : 10, 'zip' : 10, 'email' : 16})
+        
+    #-----------------------------
+    # testStream
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL, "Temporarily disabled")
+    def testStream(self):
+        produced = []
+
+        async def producer(lines):
+            # Stand-in for records arriving over the network:
+            for line in lines:
+                produced.append(line)
+                await asyncio.sleep(0)
+                yield line
+
+        async def consume(scrubber, records, **kwargs):
+            scrubbed = []
+            async for clean in scrubber.stream(records, **kwargs):
+                # Input must not run far ahead of the consumer:
+                self.assertLessEqual(len(produced) - len(scrubbed), 3 * 2 + 3 + 1)
+                scrubbed.append(clean)
+            return scrubbed
+
+        lines = self.txt_tst_lines * 20
+        truth = self.redacted_lines_txt * 20
+        for workers in (1, 2):
+            del produced[:]
+            scrubbed = asyncio.run(consume(TextScrubber(workers=workers), 
+                                           producer(lines), 
+                                           batch_size=3, 
+                                           concurrency=2))
+            self.assertEqual([line.rstrip() for line in scrubbed], truth)
+
+        # CSV scrubbers stream rows, and plain iterables work as well:
+        del produced[:]
+        rows = [line.split(',') for line in self.csv_tst_lines]
+        scrubbed = asyncio.run(consume(CSVScrubber(ignore_cols=[0]), rows))
+        self.assertEqual([','.join(row).rstrip() for row in scrubbed], self.redacted_lines_not_column_0_csv)
+
+        async def failing_producer():
+            yield 'foo@gmail.com'
+            raise IOError('connection lost')
+
+        with self.assertRaises(IOError):
+            asyncio.run(consume(TextScrubber(), failing_producer()))
+        
+    #-----------------------------
+    # testScrubMany
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL, "Temporarily disabled")
+    def testScrubMany(self):
+        anonymizer = TextScrubber()
+        scrubbed = anonymizer.scrub_many(iter(self.txt_tst_lines + [None]))
+        self.assertEqual([text.rstrip() for text in scrubbed[:-1]], self.redacted_lines_txt)
+        self.assertIsNone(scrubbed[-1])
+
+        ids = ['650-327-7398', '94025']
+        data = {'id' : ids, 'post' : ('Call 650-327-7398', 'Mail foo@gmail.com')}
+        result = anonymizer.scrub_columns(data, columns={'post' : ('email',)})
+        self.assertIs(result['id'], ids)
+        self.assertEqual(result['post'], ['Call 650-327-7398', 'Mail <emailRedac> '])
+        self.assertEqual(anonymizer.scrub_columns(data)['id'], ['<phoneRedac>', '<zipRedac>'])
+        with self.assertRaises(KeyError):
+            anonymizer.scrub_columns(data, columns=['zip'])
+
+    #-----------------------------
+    # testScrubManyNumpyPandas
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL or numpy is None or pandas is None, "Needs numpy and pandas")
+    def testScrubManyNumpyPandas(self):
+        anonymizer = TextScrubber()
+        array = numpy.array([['zip 94025', None], ['foo', 'call 650-327-7398']], dtype=object)
+        scrubbed = anonymizer.scrub_many(array)
+        self.assertEqual(scrubbed.shape, (2, 2))
+        self.assertEqual(scrubbed.tolist(), [['zip <zipRedac>', None], ['foo', 'call <phoneRedac>']])
+
+        frame = pandas.DataFrame({'id' : [1, 2], 'post' : ['zip 94025', numpy.nan]}, index=['a', 'b'])
+        result = anonymizer.scrub_columns(frame, columns=['post'])
+        self.assertEqual(list(result.index), ['a', 'b'])
+        self.assertEqual(result['post']['a'], 'zip <zipRedac>')
+        self.assertTrue(pandas.isna(result['post']['b']))
+        self.assertEqual(frame['post']['a'], 'zip 94025')
+        
+    #-----------------------------
+    # testRunStats
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL, "Temporarily disabled")
+    def testRunStats(self):
+        self.assertIsNone(TextScrubber().stats)
+
+        anonymizer = TextScrubber(self.tst_txt_infile, self.tst_outfile_fd.name, collect_stats=True, num_slowest=3)
+        anonymizer.anonymize()
+        self.assertEqual([line.rstrip() for line in self.tst_outfile_fd], self.redacted_lines_txt)
+        stats = anonymizer.stats
+        self.assertEqual(stats.fields, 7)
+        self.assertEqual(stats.detectors['email']['calls'], 1)
+        self.assertEqual(stats.detectors['email']['matches'], 1)
+        self.assertEqual(stats.detectors['email']['bytes_in'], len('An email address foo@gmail.com'))
+        self.assertEqual(stats.detectors['email']['bytes_out'], len('An email address <emailRedac> '))
+        self.assertEqual(len(stats.slowest), 3)
+        self.assertTrue(all(1 <= row_num <= 7 for _seconds, row_num in stats.slowest))
+
+        # Statistics from worker processes add up to the serial ones,
+        # and row numbers continue across batches:
+        serial = CSVScrubber(self.tst_csv_infile, self.tst_outfile_fd.name, collect_stats=True, num_slowest=20)
+        serial.anonymize()
+        parallel = CSVScrubber(self.tst_csv_infile, self.tst_outfile_fd.name, 
+                               workers=2, batch_size=2, collect_stats=True, num_slowest=20)
+        parallel.anonymize()
+        for name in ('phone', 'zip', 'email'):
+            for key in ('calls', 'matches', 'bytes_in', 'bytes_out'):
+                self.assertEqual(parallel.stats.detectors[name][key], serial.stats.detectors[name][key])
+        self.assertEqual(parallel.stats.row_num, 6)
+        self.assertEqual(sorted(row_num for _seconds, row_num in parallel.stats.slowest),
+                         sorted(row_num for _seconds, row_num in serial.stats.slowest))
+        self.assertIn('row 6', parallel.report())
+        
+    #-----------------------------
+    # testNameDictionary
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL, "Temporarily disabled")
+    def testNameDictionary(self):
+        names = NameDictionary(['Ann', 'Mary Ann Smith', "O'Brien", ''])
+        self.assertEqual(len(names), 3)
+        self.assertEqual(names.redact('ANN wrote to mary ann  smith and o\'brien.'),
+                         '<nameRedac> wrote to <nameRedac> and <nameRedac>.')
+        # Word boundaries, and no matching across punctuation:
+        self.assertEqual(names.redact('Annual report'), 'Annual report')
+        self.assertEqual(names.redact('Mary Ann, Smith'), 'Mary <nameRedac>, Smith')
+        # Possessives and hyphenated words:
+        names = NameDictionary(['Ann', 'Smith', 'Mary Ann Smith', "O'Brien", 'Smith-Jones'])
+        self.assertEqual(names.redact("Ann's post, Smith’s reply, Smith-Jones"),
+                         "<nameRedac>'s post, <nameRedac>’s reply, <nameRedac>")
+        self.assertEqual(names.redact("mary ann smith's cat, O'Brien's dog, ANN'S"),
+                         "<nameRedac>'s cat, <nameRedac>'s dog, <nameRedac>'S")
+        self.assertEqual(names.redact("Smith-Miller, Lee-Ann's, Jones-Smith's, Anns"),
+                         "<nameRedac>-Miller, Lee-<nameRedac>'s, Jones-<nameRedac>'s, Anns")
+
+        with NamedTemporaryFile(prefix='anonymization_tst', suffix='.txt', dir='/tmp', mode='w') as names_fd:
+            names_fd.write('Ann\nMary Ann Smith\n')
+            names_fd.flush()
+            trie_file = names_fd.name + '.trie'
+            try:
+                built = NameDictionary.load_or_build(names_fd.name)
+                self.assertTrue(os.path.exists(trie_file))
+                loaded = NameDictionary.load_or_build(names_fd.name)
+                self.assertEqual((loaded.names, loaded.first_words), (built.names, built.first_words))
+            finally:
+                os.remove(trie_file)
+            with open(trie_file, 'w') as fd:
+                fd.write('garbage')
+            try:
+                with self.assertRaises(ValueError):
+                    NameDictionary.load(trie_file)
+            finally:
+                os.remove(trie_file)
+
+        anonymizer = TextScrubber(names=names)
+        self.assertEqual(anonymizer.anonymize_text('Ann: call 650-327-7398'), '<nameRedac>: call <phoneRedac>')
+        
+    #-----------------------------
+    # testIncremental
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL, "Temporarily disabled")
+    def testIncremental(self):
+        with NamedTemporaryFile(prefix='anonymization_tst', suffix='.txt', dir='/tmp', mode='w+') as infile_fd, \
+             NamedTemporaryFile(prefix='anonymization_tst', suffix='.txt', dir='/tmp', mode='w+') as full_fd:
+            checkpoint = self.tst_outfile_fd.name + '.ckpt'
+            for scrubber_class, lines, kwargs in ((TextScrubber, self.txt_tst_lines, {'shard_size' : 50}),
+                                                  (CSVScrubber, self.csv_tst_lines, {'checkpoint_rows' : 2, 'batch_size' : 1})):
+                data = ''.join(line + '\n' for line in lines)
+                infile_fd.seek(0)
+                infile_fd.truncate()
+                infile_fd.write(data)
+                infile_fd.flush()
+                scrubber_class(infile_fd.name, full_fd.name, **kwargs).anonymize()
+                full_fd.seek(0)
+                full = full_fd.read()
+
+                # Scrub the input as it grows, ending in a partial line:
+                infile_fd.seek(0)
+                infile_fd.truncate()
+                cut = len(data) // 2
+                for part in (data[:cut], data[cut:-3], data[-3:]):
+                    infile_fd.write(part)
+                    infile_fd.flush()
+                    scrubber_class(infile_fd.name, self.tst_outfile_fd.name, checkpoint=checkpoint, **kwargs).anonymize()
+                self.tst_outfile_fd.seek(0)
+                self.assertEqual(self.tst_outfile_fd.read(), full)
+                with open(checkpoint, 'r') as fd:
+                    self.assertEqual(json.load(fd)['rows'], len(lines))
+
+                # Output written after the last checkpoint is dropped:
+                with open(self.tst_outfile_fd.name, 'a') as fd:
+                    fd.write('left by a crash')
+                infile_fd.write('Call 650-327-7398\n')
+                infile_fd.flush()
+                scrubber_class(infile_fd.name, self.tst_outfile_fd.name, checkpoint=checkpoint, **kwargs).anonymize()
+                self.tst_outfile_fd.seek(0)
+                self.assertTrue(self.tst_outfile_fd.read().startswith(full + 'Call <phoneRedac>'))
+
+                # Input that changed other than by appending is refused:
+                infile_fd.seek(0)
+                infile_fd.write('X')
+                infile_fd.flush()
+                with self.assertRaises(ValueError):
+                    scrubber_class(infile_fd.name, self.tst_outfile_fd.name, checkpoint=checkpoint, **kwargs).anonymize()
+                os.remove(checkpoint)
+
+            # A quoted cell that spans lines waits until its record is complete:
+            for streaming in (True, False):
+                infile_fd.seek(0)
+                infile_fd.truncate()
+                for part in ('a,b\n1,"call\n', '650-327-7398 now"\n2,x\n'):
+                    infile_fd.write(part)
+                    infile_fd.flush()
+                    CSVScrubber(infile_fd.name, self.tst_outfile_fd.name, streaming=streaming, checkpoint=checkpoint).anonymize()
+                CSVScrubber(infile_fd.name, full_fd.name, streaming=streaming).anonymize()
+                self.tst_outfile_fd.seek(0)
+                full_fd.seek(0)
+                self.assertEqual(self.tst_outfile_fd.read(), full_fd.read())
+                os.remove(checkpoint)
+
+    #-----------------------------
+    # testCompressedIO
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL, "Temporarily disabled")
+    def testCompressedIO(self):
+        extensions = ['.gz', '.bz2', '.xz']
+        try:
+            open_binary(io.BytesIO(), 'wb', 'zstd').close()
+            extensions.append('.zst')
+        except ValueError:
+            pass
+        for extension in extensions:
+            compression = compression_for('x' + extension)
+            with NamedTemporaryFile(prefix='anonymization_tst', suffix=extension, dir='/tmp') as infile_fd, \
+                 NamedTemporaryFile(prefix='anonymization_tst', suffix=extension, dir='/tmp') as outfile_fd:
+                with open_binary(infile_fd.name, 'wb', compression) as fd:
+                    fd.write(''.join(line + '\n' for line in self.txt_tst_lines).encode('ascii'))
+                for workers, io_threads in ((1, False), (2, True)):
+                    TextScrubber(infile_fd.name, outfile_fd.name, workers=workers, io_threads=io_threads).anonymize()
+                    with open_binary(outfile_fd.name, 'rb', compression) as fd:
+                        self.assertEqual([line.rstrip() for line in fd.read().decode('ascii').splitlines()], self.redacted_lines_txt)
+
+                # Compression can be set regardless of extension:
+                CSVScrubber(self.tst_csv_infile, outfile_fd.name, out_compression='none', io_threads=True).anonymize()
+                with open(outfile_fd.name, 'r') as fd:
+                    self.assertEqual([line.rstrip() for line in fd], self.redacted_lines_all_columns_csv)
+
+    #-----------------------------
+    # testPseudonymize
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL, "Temporarily disabled")
+    def testPseudonymize(self):
+        anonymizer = TextScrubber(pseudonymizer=Pseudonymizer(b'secret'))
+        scrubbed = anonymizer.anonymize_text('Call (650) 327-7398 or 1-650-327-7398, mail John.Doe@Stanford.edu now')
+        tokens = re.findall(r'<(phone|email):([0-9a-f]{12})>', scrubbed)
+        self.assertEqual([name for name, _digest in tokens], ['phone', 'phone', 'email'])
+        self.assertEqual(tokens[0], tokens[1])
+        self.assertTrue(scrubbed.endswith('> now'))
+        self.assertEqual(anonymizer.anonymize_text('john.doe@stanford.edu'), '<email:%s> ' % tokens[2][1])
+        other_key = TextScrubber(pseudonymizer=Pseudonymizer(b'other secret', token_length=6))
+        self.assertRegex(other_key.anonymize_text('94025'), r'^<zip:[0-9a-f]{6}>$')
+        self.assertNotEqual(other_key.anonymize_text('650-327-7398'), '<phone:%s>' % tokens[0][1][:6])
+
+        # Workers compute the same tokens, and send back their cache counts:
+        TextScrubber(self.tst_txt_infile, self.tst_outfile_fd.name, pseudonymizer=Pseudonymizer(b'secret')).anonymize()
+        serial = self.tst_outfile_fd.read()
+        pseudonymizer = Pseudonymizer(b'secret')
+        with NamedTemporaryFile(prefix='anonymization_tst', suffix='.txt', dir='/tmp', mode='w+') as parallel_fd:
+            TextScrubber(self.tst_txt_infile, parallel_fd.name, workers=2, shard_size=50, pseudonymizer=pseudonymizer).anonymize()
+            self.assertEqual(parallel_fd.read(), serial)
+        self.assertEqual(pseudonymizer.cache.misses, 6)
+
+    #-----------------------------
+    # testOutputChunks
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL, "Temporarily disabled")
+    def testOutputChunks(self):
+        with NamedTemporaryFile(prefix='anonymization_tst', suffix='.txt', dir='/tmp', mode='w+') as chunked_fd:
+            for scrubber_class, infile in ((TextScrubber, self.tst_txt_infile), (CSVScrubber, self.tst_csv_infile)):
+                scrubber_class(infile, self.tst_outfile_fd.name, line_buffered=True).anonymize()
+                self.tst_outfile_fd.seek(0)
+                line_buffered = self.tst_outfile_fd.read()
+                # Chunks of a few rows each:
+                scrubber = scrubber_class(infile, chunked_fd.name, io_buffer_size=50)
+                if scrubber_class is CSVScrubber:
+                    scrubber.batch_size = 2
+                scrubber.anonymize()
+                chunked_fd.seek(0)
+                self.assertEqual(chunked_fd.read(), line_buffered)
+
+    #-----------------------------
+    # testParquet
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL or pyarrow is None, "Needs pyarrow")
+    def testParquet(self):
+        # Fullwidth digits only reach the scrubber through the non-ASCII part of the mask:
+        texts = self.txt_tst_lines + ['zip \uff19\uff14\uff10\uff12\uff15 here', None]
+        table = pyarrow.table({'text'  : pyarrow.array(texts),
+                               'large' : pyarrow.array(texts, type=pyarrow.large_string()),
+                               'zip'   : pyarrow.array(texts).dictionary_encode(),
+                               'keep'  : pyarrow.array(texts),
+                               'num'   : pyarrow.array(range(len(texts)))
+                               })
+        with NamedTemporaryFile(prefix='anonymization_tst', suffix='.parquet', dir='/tmp') as infile_fd, \
+             NamedTemporaryFile(prefix='anonymization_tst', suffix='.parquet', dir='/tmp') as outfile_fd:
+            pyarrow.parquet.write_table(table, infile_fd.name, row_group_size=3)
+            ParquetScrubber(infile_fd.name, outfile_fd.name, ignore_cols=['keep'], profile={2 : ['zip']}, batch_size=2).anonymize()
+            scrubbed = pyarrow.parquet.read_table(outfile_fd.name)
+
+        self.assertEqual(scrubbed.schema, table.schema)
+        anonymizer = TextScrubber()
+        truth = [anonymizer.anonymize_text(text) if text is not None else None for text in texts]
+        self.assertEqual(scrubbed.column('text').to_pylist(), truth)
+        self.assertEqual(truth[-2], 'zip <zipRedac> here')
+        self.assertEqual(scrubbed.column('large').to_pylist(), truth)
+        zip_engine = get_engine(('zip',))
+        self.assertEqual(scrubbed.column('zip').to_pylist(), 
+                         [anonymizer.anonymize_text(text, zip_engine) if text is not None else None for text in texts])
+        self.assertEqual(scrubbed.column('keep').to_pylist(), texts)
+        self.assertEqual(scrubbed.column('num'), table.column('num'))
+
+    #-----------------------------
+    # testServer
+    #-----------------------    
+
+    @unittest.skipIf(not TEST_ALL, "Temporarily disabled")
+    def testServer(self):
+        TextScrubber(self.tst_txt_infile, self.tst_outfile_fd.name).anonymize()
+        with open(self.tst_outfile_fd.name, 'rb') as fd:
+            txt_truth = fd.read()
+        csv_input = b'"Call\r\n650-327-7398",keep,"multi\nline 94025"\n' * 10
+        csv_request = {'kind' : 'csv', 'streaming' : True, 'ignore_cols' : [1], 'profile' : ['2=zip']}
+        with NamedTemporaryFile(prefix='anonymization_tst', suffix='.csv', dir='/tmp') as infile_fd:
+            infile_fd.write(csv_input)
+            infile_fd.flush()
+            CSVScrubber(infile_fd.name, self.tst_outfile_fd.name, streaming=True, ignore_cols=[1], profile={2 : ['zip']}).anonymize()
+        with open(self.tst_outfile_fd.name, 'rb') as fd:
+            csv_truth = fd.read()
+        with open(self.tst_txt_infile, 'rb') as fd:
+            txt_input = fd.read()
+        # Quotes inside unquoted cells are text to csv.reader, and do not start a quoted cell:
+        stray_input = b'6\'2" tall,"call\n650-327-7398",x\n' * 3
+        stray_truths = {}
+        for streaming in (True, False):
+            with NamedTemporaryFile(prefix='anonymization_tst', suffix='.csv', dir='/tmp') as infile_fd:
+                infile_fd.write(stray_input)
+                infile_fd.flush()
+                CSVScrubber(infile_fd.name, self.tst_outfile_fd.name, streaming=streaming).anonymize()
+            with open(self.tst_outfile_fd.name, 'rb') as fd:
+                stray_truths[streaming] = fd.read()
+        self.assertEqual(stray_truths[True].count(b'<phoneRedac>'), 3)
+
+        with TemporaryDirectory(prefix='anonymization_tst') as socket_dir:
+            # The server creates a missing socket directory, for its user only:
+            socket_path = os.path.join(socket_dir, 'run', 'anonymizer.sock')
+            for workers in (1, 2):
+                # Small chunks, so that lines and records are split across them:
+                server = ScrubServer(socket_path, workers=workers, chunk_size=20, max_record_size=200)
+                server_thread = threading.Thread(target=server.run, daemon=True)
+                server_thread.start()
+                self.assertTrue(server.started.wait(10))
+                try:
+                    self.assertEqual(stat.S_IMODE(os.stat(os.path.dirname(socket_path)).st_mode), 0o700)
+                    self.assertEqual(stat.S_IMODE(os.stat(socket_path).st_mode), 0o600)
+                    outputs = {}
+                    def run_client(name, request, data):
+                        outfile = io.BytesIO()
+                        scrub(socket_path, request, io.BytesIO(data), outfile, chunk_size=7)
+                        outputs[name] = outfile.getvalue()
+                    clients = [threading.Thread(target=run_client, args=('txt%s' % i, {'kind' : 'txt'}, txt_input)) for i in range(3)]
+                    clients += [threading.Thread(target=run_client, args=('csv%s' % i, csv_request, csv_input)) for i in range(3)]
+                    for client in clients:
+                        client.start()
+                    for client in clients:
+                        client.join()
+                    for i in range(3):
+                        self.assertEqual(outputs['txt%s' % i], txt_truth)
+                        self.assertEqual(outputs['csv%s' % i], csv_truth)
+                    for streaming in (True, False):
+                        run_client('stray', {'kind' : 'csv', 'streaming' : streaming}, stray_input)
+                        self.assertEqual(outputs['stray'], stray_truths[streaming])
+
+                    with self.assertRaises(ValueError):
+                        scrub(socket_path, {'kind' : 'csv', 'profile' : ['comment=zip']}, io.BytesIO(csv_input), io.BytesIO())
+                    # An unbalanced quote is refused, rather than buffered without end:
+                    with self.assertRaisesRegex(ValueError, 'unbalanced'):
+                        scrub(socket_path, {'kind' : 'csv'}, io.BytesIO(b'a,"open\n' + b'b,c\n' * 100), io.BytesIO())
+                finally:
+                    server.stop()
+                    server_thread.join()
+                self.assertFalse(os.path.exists(socket_path))
+
+            # Only a socket is removed from the socket path, never a file:
+            file_path = os.path.join(socket_dir, 'run', 'notes.txt')
+            with open(file_path, 'w') as fd:
+                fd.write('notes')
+            with self.assertRaises(ValueError):
+                ScrubServer(file_path).remove_stale_socket()
+            self.assertTrue(os.path.exists(file_path))
+
+        # Sockets in directories that other users can write to are refused:
+        with self.assertRaises(ValueError):
+            ScrubServer(os.path.join(gettempdir(), 'anonymizer_tst.sock')).prepare_directory()
+
+        # Chunks end where csv.reader ends records, whichever piece of input that is in:
+        splitter = ChunkSplitter(True, True, 1, 1000)
+        splitter.add('a,"x\n')
+        self.assertEqual(splitter.take(), '')
+        splitter.add('y"\nb,"z')
+        self.assertEqual(splitter.take(), 'a,"x\ny"\n')
+        # A final \r may be half of a \r\n:
+        splitter.add('\n"\nc\r')
+        self.assertEqual(splitter.take(), 'b,"z\n"\n')
+        self.assertEqual(splitter.take_all(), 'c\r')
+        splitter = ChunkSplitter(True, True, 1, 1000)
+        splitter.add('6\'2" tall,x\r\nc')
+        self.assertEqual(splitter.take(), '6\'2" tall,x\r\n')
+        self.assertEqual(splitter.take_all(), 'c')
+
     #--------------------------- Utilities ---------------------
     
     #-----------------------------